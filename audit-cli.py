@@ -0,0 +1,76 @@
+"""
+# audit-cli.py
+
+CLI interface to the `mh-mtd-updater` to audit records in the database-table:
+shows what was stored for them (the original metadata, in whichever storage
+mode it was stored, and the update object).
+"""
+
+# Std
+import argparse
+# Libs
+from mediahaven.mediahaven import AcceptFormat
+# Local
+from services.db import DatabaseService
+from services.mh_client import LazyMediaHaven, load_config
+from services.ratelimit import RateLimiter
+from services.storage import load_original_metadata, sha256_of
+
+# The client is only created (and its token requested) on first use
+mh_client = LazyMediaHaven()
+# Unlimited: only for retries (eg. with a renewed token)
+rate_limiter = RateLimiter()
+
+
+def audit_item(database: DatabaseService, fragment_id: str, check: bool):
+    item = database.get_item(fragment_id)
+    if item is None:
+        print(f"{fragment_id}: not found in '{database.table}'.")
+        return
+    print(f"{fragment_id}: status={item.status}, jira_ticket={item.jira_ticket}, modified_at={item.modified_at}")
+    if item.error:
+        print(f"Error: {item.error}: {item.error_msg}")
+    original_metadata = load_original_metadata(item)
+    if original_metadata is not None:
+        print(f"Original metadata:\n{original_metadata}")
+    elif item.original_metadata_sha256:
+        print(f"Original metadata: SHA-256 {item.original_metadata_sha256}")
+    else:
+        print("Original metadata: not stored.")
+    print(f"Update object:\n{item.update_object}")
+    if check and item.original_metadata_sha256:
+        # Only a hash can be compared exactly: a reduced sidecar can not
+        current = rate_limiter.call(
+            mh_client.records.get, fragment_id, accept_format=AcceptFormat.XML
+        ).raw_response
+        same = sha256_of(current) == item.original_metadata_sha256
+        print(f"Current metadata in MediaHaven: {'same as' if same else 'differs from'} the original.")
+
+
+def main():
+    svc_desc = """Python CLI interface to the `mh-mtd-updater`.
+    Shows what was stored in the database for the given fragments."""
+    parser = argparse.ArgumentParser(description=svc_desc)
+    parser.add_argument(
+        "fragment_ids",
+        type=str,
+        nargs="+",
+        help="FragmentId(s) of the records to audit.",
+    )
+    parser.add_argument(
+        "--check",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="""For records of which only the hash was stored: compare it with the current metadata in MediaHaven.""",
+    )
+
+    args = parser.parse_args()
+    config = load_config()
+    database = DatabaseService(config, config["database"]["table"], pool_size=1)
+    for fragment_id in args.fragment_ids:
+        audit_item(database, fragment_id, args.check)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+# benchmark.py
+
+End-to-end throughput benchmark of `db-cli.py` and `csv-cli.py` against the
+local MediaHaven stand-in (`fake_mediahaven.py`).
+
+- `db`: seeds a throwaway Postgres (given by `--dsn`, its table is dropped and
+  recreated!) with N TODO-rows and runs `db-cli.py` over them.
+- `csv`: generates a CSV of N rows and runs `csv-cli.py` over it, in a
+  temporary working directory.
+
+Reports records per second, p50/p99 latency per stage of the pipeline (from
+the histograms the CLI writes with `--metrics-file`: eg. `db_claim`,
+`transform`, `db_write`, `html_report`), p50/p99 of the server-side latency
+per MediaHaven endpoint and the peak RSS of the CLI. Extra arguments after
+`--` are passed on to the CLI, eg.:
+
+    python bench/benchmark.py db --dsn postgresql://bench@localhost/bench -n 1000 -- --workers 8
+    python bench/benchmark.py csv -n 5000 --latency 0.05 -- --concurrency 4 --no-dryrun
+"""
+
+# Std
+import os
+import re
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from os.path import abspath, dirname, join
+from statistics import quantiles
+# Local
+from fake_mediahaven import FakeMediaHaven
+
+REPO_DIR = abspath(join(dirname(__file__), ".."))
+BENCH_TABLE = "bench_mh_mtd_cleanup"
+
+# The columns of `schema.sql`, with the claim-index of `migrations/002_work_queue.sql`,
+# without triggers and permissions
+BENCH_DDL = f"""
+DROP TABLE IF EXISTS public.{BENCH_TABLE};
+CREATE TABLE public.{BENCH_TABLE} (
+    fragment_id varchar(96) NOT NULL PRIMARY KEY,
+    cp_id varchar(10) NOT NULL,
+    jira_ticket varchar(10) NULL,
+    original_metadata xml NULL,
+    update_object xml NULL,
+    transformations json NULL,
+    status TEXT NOT NULL CHECK (status IN ('PENDING', 'TODO', 'IN_PROGRESS', 'DONE', 'ERROR', 'ON_HOLD')) DEFAULT ('PENDING'),
+    error TEXT NULL,
+    error_msg TEXT NULL,
+    created_at timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    modified_at timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX ON public.{BENCH_TABLE} (jira_ticket, created_at, fragment_id) WHERE status = 'TODO';
+"""
+
+
+# eg. `mh_mtd_updater_stage_seconds_bucket{stage="transform",le="0.05"} 42`
+STAGE_BUCKET = re.compile(r'^\w+_stage_seconds_bucket\{stage="([^"]+)",le="([^"]+)"\} (\S+)$')
+
+
+def percentile(values: list, q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def read_stage_histograms(path: str) -> dict:
+    """The cumulative buckets, as `[(upper bound, count), ...]`, per stage in
+    the metrics file (Prometheus text format) written by the CLI."""
+    histograms = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            match = STAGE_BUCKET.match(line.strip())
+            if match:
+                stage, le, count = match.groups()
+                histograms.setdefault(stage, []).append((float(le), float(count)))
+    return histograms
+
+
+def histogram_quantile(buckets: list, q: float) -> float:
+    """Estimate the q-quantile from cumulative buckets, interpolating linearly
+    within a bucket (as Prometheus' `histogram_quantile`). Observations in the
+    +Inf-bucket are reported as the highest finite bound."""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return 0.0
+    rank = q * total
+    lower, below = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (rank - below) / (count - below) if count > below else lower
+        lower, below = bound, count
+    return lower
+
+
+def start_fake_mediahaven(args) -> FakeMediaHaven:
+    server = FakeMediaHaven(("127.0.0.1", 0), args.latency, args.rate_429, args.rate_5xx)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def cli_env(server: FakeMediaHaven, db: dict = {}) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "MH_HOST": server.url,
+        "MH_USER": "bench",
+        "MH_PASSWORD": "bench",
+        "MH_CLIENT_ID": "bench",
+        "MH_CLIENT_SECRET": "bench",
+        "DB_HOST": str(db.get("host", "localhost")),
+        "DB_PORT": str(db.get("port", "5432")),
+        "DB_USER": str(db.get("user", "")),
+        "DB_PASSWORD": str(db.get("password", "")),
+        "DB_NAME": str(db.get("dbname", "")),
+        "DB_TABLE": BENCH_TABLE,
+    })
+    return env
+
+
+def run_cli(cmd: list, env: dict, cwd: str) -> tuple:
+    """Run the CLI, discarding its output. Returns the wall-clock duration and
+    the stage histograms of its metrics file."""
+    with tempfile.TemporaryDirectory() as metrics_dir:
+        metrics_file = join(metrics_dir, "metrics.prom")
+        start = time.monotonic()
+        subprocess.run([*cmd, "--metrics-file", metrics_file], env=env, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        duration = time.monotonic() - start
+        return duration, read_stage_histograms(metrics_file)
+
+
+def seed_db(dsn: str, n: int) -> dict:
+    import psycopg
+    from psycopg.conninfo import conninfo_to_dict
+    with psycopg.connect(dsn) as conn:
+        conn.execute(BENCH_DDL)
+        conn.execute(
+            f"""INSERT INTO public.{BENCH_TABLE} (fragment_id, cp_id, jira_ticket, status)
+            SELECT 'bench-' || i, 'OR-bench', 'BENCH-1', 'TODO' FROM generate_series(1, %s) AS i""",
+            (n,),
+        )
+    return conninfo_to_dict(dsn)
+
+
+def bench_db(args, server: FakeMediaHaven) -> tuple:
+    db = seed_db(args.dsn, args.n)
+    cmd = [sys.executable, join(REPO_DIR, "db-cli.py"), "--reason", "BENCH-1", *args.cli_args]
+    return run_cli(cmd, cli_env(server, db), REPO_DIR)
+
+
+def bench_csv(args, server: FakeMediaHaven) -> tuple:
+    with tempfile.TemporaryDirectory() as workdir:
+        # The CLI expects its config, stylesheets and reports-dir in the cwd
+        for name in ("config.yml", "xslt"):
+            os.symlink(join(REPO_DIR, name), join(workdir, name))
+        os.mkdir(join(workdir, "reports"))
+        csv_path = join(workdir, "bench.csv")
+        with open(csv_path, "w", encoding="utf-8") as f:
+            f.write(f"{args.id_col},{args.data_col}\n")
+            for i in range(1, args.n + 1):
+                value = f"missing-{i}" if args.missing and i % args.missing == 0 else f"bench-{i}"
+                f.write(f"{value},Benchmark value {i % 10}\n")
+        cmd = [
+            sys.executable, join(REPO_DIR, "csv-cli.py"), csv_path,
+            "--or_id", "OR-bench", "--reason", "BENCH-1", *args.cli_args,
+        ]
+        return run_cli(cmd, cli_env(server), workdir)
+
+
+def report(args, server: FakeMediaHaven, duration: float, stages: dict):
+    print(f"Records:      {args.n}")
+    print(f"Duration:     {duration:.2f}s")
+    print(f"Throughput:   {args.n / duration:.1f} records/s")
+    # Linux reports ru_maxrss in KiB
+    print(f"Peak RSS:     {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.1f} MiB")
+    print(f"{'Stage':<14} {'Count':>9} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    for stage, buckets in sorted(stages.items()):
+        count = int(buckets[-1][1])
+        print(f"{stage:<14} {count:>9} {histogram_quantile(buckets, 0.5) * 1000:>9.1f} {histogram_quantile(buckets, 0.99) * 1000:>9.1f}")
+    print(f"{'Endpoint':<10} {'Requests':>9} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    for endpoint, timings in sorted(server.timings.items()):
+        print(f"{endpoint:<10} {len(timings):>9} {percentile(timings, 50) * 1000:>9.1f} {percentile(timings, 99) * 1000:>9.1f}")
+    print(f"Responses:    {dict(sorted(server.status_counts.items()))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark against a fake MediaHaven.")
+    parser.add_argument("cli", choices=["db", "csv"], help="The CLI to benchmark.")
+    parser.add_argument("-n", type=int, default=1000, help="Number of records (default: 1000)")
+    parser.add_argument("--dsn", type=str, help="DSN of a throwaway Postgres (required for `db`)")
+    parser.add_argument("--id-col", type=str, default="Dynamic.dc_identifier_localid", help="Identifier column of the CSV (`csv` only)")
+    parser.add_argument("--data-col", type=str, default="Dynamic.dc_title", help="Data column of the CSV (`csv` only)")
+    parser.add_argument("--missing", type=int, default=0, help="Make every Nth CSV-identifier not found (`csv` only)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency per MediaHaven request (default: 0)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of MediaHaven requests answered with 429 (default: 0)")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="Fraction of MediaHaven requests answered with 503 (default: 0)")
+    # Everything after `--` is meant for the CLI
+    argv = sys.argv[1:]
+    split = argv.index("--") if "--" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    args.cli_args = argv[split + 1:]
+    if args.cli == "db" and not args.dsn:
+        parser.error("the `db` benchmark requires --dsn")
+
+    server = start_fake_mediahaven(args)
+    duration, stages = bench_db(args, server) if args.cli == "db" else bench_csv(args, server)
+    server.shutdown()
+    report(args, server, duration, stages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+# fake_mediahaven.py
+
+Local stand-in for the MediaHaven REST API, for benchmarking: implements the
+endpoints used by the CLIs (OAuth ROPC token, `records`-search, GET and update
+of a record) with configurable latency, 429-rate and 5xx-rate.
+
+Records are generated on the fly: every identifier value that is searched for
+matches one record (except values starting with `missing`), and every
+FragmentId can be fetched.
+
+Run standalone with:
+
+    python bench/fake_mediahaven.py --port 8080 --latency 0.05 --rate-429 0.01
+"""
+
+# Std
+import re
+import json
+import time
+import hashlib
+import random
+import argparse
+import threading
+from collections import defaultdict
+from datetime import datetime as dt, timezone as tz
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+MHS = "https://zeticon.mediahaven.com/metadata/25.1/mhs/"
+MH = "https://zeticon.mediahaven.com/metadata/25.1/mh/"
+
+QUERY_TERM = re.compile(r'([\w.]+):"((?:[^"\\]|\\.)*)"')
+
+
+def sidecar(fragment_id: str, or_id: str, id_key: str, id_value: str, last_modified: str) -> str:
+    field = id_key.split(".")[-1]
+    return f"""<mhs:Sidecar xmlns:mhs="{MHS}" xmlns:mh="{MH}" version="25.1">
+  <mhs:Descriptive>
+    <mh:Title>Title of {escape(id_value)}</mh:Title>
+    <mh:Description>Description of {escape(id_value)}</mh:Description>
+  </mhs:Descriptive>
+  <mhs:Structural/>
+  <mhs:Administrative>
+    <mh:ExternalId>{fragment_id[:10]}</mh:ExternalId>
+    <mh:Type>Video</mh:Type>
+    <mh:LastModifiedDate>{last_modified}</mh:LastModifiedDate>
+  </mhs:Administrative>
+  <mhs:Internal>
+    <mh:MediaObjectId>{fragment_id[:32]}</mh:MediaObjectId>
+    <mh:FragmentId>{fragment_id}</mh:FragmentId>
+    <mh:PathToKeyframe>https://example.org/{fragment_id}.jpg</mh:PathToKeyframe>
+  </mhs:Internal>
+  <mhs:Dynamic>
+    <CP_id>{escape(or_id)}</CP_id>
+    <{field}>{escape(id_value)}</{field}>
+  </mhs:Dynamic>
+</mhs:Sidecar>"""
+
+
+class FakeMediaHaven(ThreadingHTTPServer):
+    """The server holds the configuration, the last-modified dates of updated
+    records and the (server-side) latency per endpoint."""
+    daemon_threads = True
+
+    def __init__(self, address, latency: float = 0.0, rate_429: float = 0.0, rate_5xx: float = 0.0):
+        super().__init__(address, Handler)
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.lock = threading.Lock()
+        self.last_modified = {}
+        self.timings = defaultdict(list)
+        self.status_counts = defaultdict(int)
+
+    def record(self, endpoint: str, status: int, duration: float):
+        with self.lock:
+            self.timings[endpoint].append(duration)
+            self.status_counts[f"{endpoint} {status}"] += 1
+
+    def get_last_modified(self, fragment_id: str) -> str:
+        with self.lock:
+            return self.last_modified.get(fragment_id, "2020-01-01T00:00:00Z")
+
+    def touch(self, fragment_id: str):
+        with self.lock:
+            self.last_modified[fragment_id] = dt.now(tz.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: FakeMediaHaven
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def handle_request(self, method: str):
+        start = time.monotonic()
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if method == "POST" and ("auth" in parts or "oauth" in parts or url.path.endswith("token")):
+            endpoint, handler = "token", self.token
+        elif parts and parts[-1] == "records" and method == "GET":
+            endpoint, handler = "search", self.search
+        elif len(parts) > 1 and parts[-2] == "records" and method == "GET":
+            endpoint, handler = "get", self.get_record
+        elif len(parts) > 1 and parts[-2] == "records":
+            endpoint, handler = "update", self.update_record
+        else:
+            endpoint, handler = "unknown", None
+        self.read_body()
+        time.sleep(self.server.latency)
+        roll = random.random()
+        if handler is None:
+            status = self.respond(404, "Not found")
+        elif endpoint != "token" and roll < self.server.rate_429:
+            status = self.respond(429, "Too many requests")
+        elif endpoint != "token" and roll < self.server.rate_429 + self.server.rate_5xx:
+            status = self.respond(503, "Service unavailable")
+        else:
+            status = handler(url, parts)
+        self.server.record(endpoint, status, time.monotonic() - start)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def respond(self, status: int, body: str, headers: dict = {}, content_type: str = "text/plain") -> int:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+        return status
+
+    def token(self, url, parts) -> int:
+        return self.respond(200, json.dumps({
+            "access_token": "fake-access-token",
+            "refresh_token": "fake-refresh-token",
+            "token_type": "Bearer",
+            "expires_in": 3600,
+        }), content_type="application/json")
+
+    def search(self, url, parts) -> int:
+        params = parse_qs(url.query)
+        terms = QUERY_TERM.findall(params.get("q", [""])[0])
+        or_id = next((v for k, v in terms if k == "Dynamic.CP_id"), "OR-fake")
+        values = [(k, v) for k, v in terms if k != "Dynamic.CP_id" and not v.startswith("missing")]
+        start = int(params.get("startIndex", ["0"])[0])
+        size = int(params.get("nrOfResults", ["25"])[0])
+        page = values[start:start + size]
+        results = "".join(
+            sidecar(self.fragment_id(v), or_id, k, v, self.server.get_last_modified(self.fragment_id(v)))
+            for k, v in page
+        )
+        return self.respond(200, (
+            f"<Response><TotalNrOfResults>{len(values)}</TotalNrOfResults>"
+            f"<StartIndex>{start}</StartIndex><NrOfResults>{len(page)}</NrOfResults>"
+            f"<Results>{results}</Results></Response>"
+        ), content_type="application/xml")
+
+    def get_record(self, url, parts) -> int:
+        fragment_id = parts[-1]
+        body = sidecar(fragment_id, "OR-fake", "Dynamic.dc_identifier_localid", fragment_id, self.server.get_last_modified(fragment_id))
+        return self.respond(200, body, content_type="application/xml")
+
+    def update_record(self, url, parts) -> int:
+        self.server.touch(parts[-1])
+        return self.respond(204, "")
+
+    @staticmethod
+    def fragment_id(value: str) -> str:
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the MediaHaven REST API.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency per request (default: 0)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered with 429 (default: 0)")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="Fraction of requests answered with 503 (default: 0)")
+    args = parser.parse_args()
+    server = FakeMediaHaven((args.host, args.port), args.latency, args.rate_429, args.rate_5xx)
+    print(f"Fake MediaHaven listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,83 +10,48 @@ import json
 from typing import Optional, Any
 import logging
 import sys
+import multiprocessing
+import os
+from os import rename
+from os.path import abspath, exists
+from collections import deque
+from itertools import chain
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime as dt
 from pprint import pformat
 # 3d
 from lxml import etree
 # Libs
-from viaa.configuration import ConfigParser
-#
-from mediahaven import MediaHaven
 from mediahaven.mediahaven import MediaHavenException, AcceptFormat
-from mediahaven.oauth2 import ROPCGrant
 from meemoo_mtd.mediahaven_config import MhFormat
-from meemoo_mtd.transformations import (
-    transform,
-    default_transformations,
-    add_default_licenses,
-    merge_transformations_lists,
-)
 # Local
 from helpers import (
     MHRecordMeta,
     get_rec_meta,
-    transformations_from_csv_row,
+    transform_record,
+    transformation_plan,
     get_mh_records,
+    get_mh_records_batch,
+    chunked,
     UpdateRun,
+    error_from,
+    error_msg_from,
 )
 from services import csv
 from services import xvrl
+from services import xpath
+from services.cache import SidecarCache
+from services.mh_client import LazyMediaHaven
+from services.journal import Journal
+from services.plan import PlanEntry, UpdatePlanWriter, fingerprint
+from services.report import ShardedReportRenderer, render_xvrl
+from services.ratelimit import RateLimiter
+from services.metrics import metrics
+from services.profiling import profiler
 
-# TODO: also present in main.py: NEEDS TO BE ORGANIZED!
-def error_from(error: Any) -> str:
-    """Turn any kind of error we might encounter into a short but intelligible
-    string.
-    Eg. MH-404 response ⇒ `MH_REC_NOTFOUND`"""
-    # The 'MH'-cases
-    if isinstance(error, MediaHavenException):
-        if error.status_code == 400:
-            return "MH_BAD_REQUEST"
-        elif error.status_code in (401, 403):
-            return "MH_UNAUTHORIZED"
-        elif error.status_code == 404:
-            return "MH_REC_NOTFOUND"
-        elif error.status_code == 429:
-            return "MH_TOO_MANY_REQUESTS"
-        elif error.status_code == 500:
-            return "MH_SERVER_ERROR"
-        else:
-            return "MH_UNKOWN_ERROR"
-    elif isinstance(error, ValueError):
-        return "MH_REC_UNCORRECTABLE"
-    # The Generic unknown case
-    else:
-        return "UNKOWN_ERROR"
-
-
-def error_msg_from(error: Any) -> str:
-    """Retrieve the `message`-attr from an error, or something else if it's
-    not present."""
-    if hasattr(error, "msg"):
-        return error.msg
-    elif hasattr(error, "message"):
-        return error.message
-    elif hasattr(error, "error_msg"):
-        return error.error_message
-    else:
-        return str(error)
-
-# Init the config: TODO,don't always init!'
-configParser = ConfigParser()
-config = configParser.app_cfg
-mh_config = config["mediahaven"]
-grant = ROPCGrant(
-    mh_config["host"],
-    mh_config["client_id"],
-    mh_config["client_secret"],
-)
-grant.request_token(mh_config["username"], mh_config["password"])
-mh_client = MediaHaven(mh_config["host"], grant)
+# The client is only created (and its token requested) on first use
+mh_client = LazyMediaHaven()
 
 # Configure logging (OR NOT?)
 # ~ log = logging.getLogger(__name__)
@@ -101,51 +66,166 @@ mh_client = MediaHaven(mh_config["host"], grant)
 # ~ logging.getLogger("mh-mtd-updater").propagate = False
 
 
-def proces_csv(args):
-    # Init vars from args
-    csv_filepath = args.input_file
-    or_id = args.or_id
-    reason = args.reason
-    csv_parsed = csv.CsvParser(csv_filepath, delimiter=args.csv_delimiter)
-    #
-    run_meta = UpdateRun(reason, csv_parsed.id_col, csv_parsed.data_cols, or_id)
-    # Perform some basic checks first
-    try:
-        csv_parsed.validate()
-    except csv.CsvInvalidError as e:
-        print(f"CsvInvalidError: {e}")
-        exit(1)
-    # Start a XVRL Report Doc
-    xvrl_report_doc = xvrl.create_XVRLReportsDoc(run_meta)
-    csv_lines = csv_parsed.iterator()
-    start_time = dt.now().astimezone()
-    xvrl_report_doc.metadata.supplemental.add(
-        xvrl.Node("StartTime", data=start_time.replace(microsecond=0).isoformat(), ns="http://www.meemoo.be/ns")
+def lookup_mh_records(chunk, run_meta, rate_limiter, cache=None, dryrun=True) -> tuple:
+    """IO-stage: look up the identifiers of a chunk of CSV-rows in one search.
+    Values found in the (optional) local cache are not searched for; except,
+    when not a `dryrun`, values cached as not found: the record may have been
+    created since (a cached record is revalidated before its update instead).
+    Returns the found records per value, the set of values served from the
+    cache and the error when the search failed (or None): the values that
+    were not found in the cache are then missing from the found records."""
+    q_values = [row[run_meta.id_col] for row in chunk if row[run_meta.id_col]]
+    found = {}
+    if cache is not None:
+        for q_value in q_values:
+            cached_records = cache.get(run_meta.or_id, run_meta.id_col, q_value)
+            if cached_records is not None and (cached_records or dryrun):
+                found[q_value] = cached_records
+    from_cache = set(found)
+    q_values = [q_value for q_value in q_values if q_value not in from_cache]
+    error = None
+    if q_values:
+        print(f'Looking up {len(q_values)} value(s) for {run_meta.id_col} in {run_meta.or_id}')
+        try:
+            with metrics.stage("mh_search"):
+                searched, unmatched = rate_limiter.call(
+                    get_mh_records_batch, mh_client, run_meta.id_col, q_values, run_meta.or_id
+                )
+                if unmatched:
+                    # Results that do not match any value as we compare them:
+                    # look up the values without results one by one
+                    for q_value in [q_value for q_value, mh_records in searched.items() if not mh_records]:
+                        searched[q_value] = rate_limiter.call(
+                            get_mh_records, mh_client, run_meta.id_col, q_value, run_meta.or_id
+                        )
+        except Exception as e:
+            # Reported on every row of the chunk, instead of ending the run
+            print(f'ERROR: Could not look up {len(q_values)} value(s) for {run_meta.id_col} in {run_meta.or_id}: {error_msg_from(e)}')
+            error = e
+        else:
+            if cache is not None:
+                for q_value, mh_records in searched.items():
+                    cache.put(run_meta.or_id, run_meta.id_col, q_value, mh_records)
+            found.update(searched)
+    return found, from_cache, error
+
+
+def revalidate_mh_record(rec, rec_meta, rate_limiter):
+    """Before a real update of a record that came from the local cache: check
+    that its last-modified date in MediaHaven is still the same. If not, the
+    fresh record is returned instead.
+    Raises a `MediaHavenException` when the record can not be fetched (eg.
+    when it was deleted since it was cached)."""
+    with metrics.stage("mh_get"):
+        mh_record_xml = rate_limiter.call(
+            mh_client.records.get, rec_meta.FragmentId, accept_format=AcceptFormat.XML
+        )
+    fresh = etree.fromstring(mh_record_xml.raw_response.encode("utf-8"))
+    if xpath.last_modified(fresh) == xpath.last_modified(rec):
+        return rec
+    print(f"Record {rec_meta.FragmentId} changed since it was cached: using the current version.")
+    return fresh
+
+
+def error_report_node(rec_meta, q_value, csv_row, err_string) -> xvrl.Node:
+    """Report node for a record (or a CSV-row) that could not be handled."""
+    report_node = xvrl.create_ReportNode(rec_meta)
+    report_node.metadata.supplemental.add(
+        xvrl.Node("IdentifierValue", data=q_value, ns="http://www.meemoo.be/ns")
     )
-    for row in csv_lines:
-        # First, skip the first line if it has no ID-value
-        # Assume the first non-header row contains the "human fieldnames".
-        if not row[run_meta.id_col]:
-            print(f"Skipping first line: ID-value for {run_meta.id_col} is empty.")
-            continue
-        # Get the object from MediaHaven
-        q_param, q_value = run_meta.id_col, row[run_meta.id_col]
-        print(f'Handling: {q_param}:{q_value} in {run_meta.or_id}')
-        mh_records = get_mh_records(mh_client, q_param, q_value, run_meta.or_id)
-        if not mh_records:
-            # Add it to the report and skip the row
-            err_string = f'WARN: Not found: {q_param}:{q_value} in {run_meta.or_id}'
-            print(err_string)
-            rec_meta = MHRecordMeta()
-            report_node = xvrl.create_ReportNode(rec_meta)
-            report_node.metadata.supplemental.add(
-                xvrl.Node("IdentifierValue", data=q_value, ns="http://www.meemoo.be/ns")
-            )
-            report_node.digest.attribs = {"valid": "false"}
-            report_node.metadata.supplemental.add(
-                xvrl.Node("CsvRow", data=pformat(row), ns="http://www.meemoo.be/ns")
+    report_node.digest.attribs = {"valid": "false"}
+    report_node.metadata.supplemental.add(csv_row)
+    detection = xvrl.Node("detection",
+        attribs={"severity": "error"}
+    )
+    msg = xvrl.Node("message",
+        attribs={"xmllang": "en"}, data=err_string
+    )
+    detection.add(msg)
+    report_node.add(detection)
+    return report_node
+
+
+def run_cpu_stage(cpu_pool, fn, *args):
+    """Run a CPU-heavy stage on the process pool, or inline without one.
+    Sampled rows are run inline when profiling, to show up in the profile."""
+    if cpu_pool is None or profiler.sampled():
+        return fn(*args)
+    return cpu_pool.submit(fn, *args).result()
+
+
+def process_row(row_num, row, lookup, run_meta, args, rate_limiter, cpu_pool, journal, cache=None) -> list:
+    """Handle one CSV-row: transform and update every MediaHaven-record found
+    for its identifier. Runs on the IO thread pool; `reduceSidecar` and
+    `transform` are handed off to the process pool.
+    Returns the row's report nodes, each with its update plan entry (or None
+    when there is nothing to update)."""
+    q_param, q_value = run_meta.id_col, row[run_meta.id_col]
+    found, from_cache, lookup_error = lookup.result()
+    # A copy: revalidated records replace the cached ones
+    mh_records = list(found.get(q_value, []))
+    csv_row = xvrl.Node("CsvRow", data=pformat(row), ns="http://www.meemoo.be/ns")
+    print(f'Handling: {q_param}:{q_value} in {run_meta.or_id}')
+    if q_value not in found and lookup_error is not None:
+        # The search failed: add it to the report and skip the row
+        err_string = f'ERROR: Could not look up {q_param}:{q_value} in {run_meta.or_id}: {error_msg_from(lookup_error)}'
+        metrics.record_done("ERROR", error_from(lookup_error))
+        return [(error_report_node(MHRecordMeta(), q_value, csv_row, err_string), None)]
+    if not mh_records:
+        # Add it to the report and skip the row
+        err_string = f'WARN: Not found: {q_param}:{q_value} in {run_meta.or_id}'
+        print(err_string)
+        metrics.record_done("ERROR", "MH_REC_NOTFOUND")
+        return [(error_report_node(MHRecordMeta(), q_value, csv_row, err_string), None)]
+    # Make list of Transformations while filtering out the identifier-column
+    # and any possible None-columns at the end.
+    # The transformations on this CSV-row need to be applied to all MH-records
+    # that might get returned for this idenifier and value.
+    plan = transformation_plan(row, run_meta.data_cols)
+    row_transfos = xvrl.Node("DynamicTransformations", data=plan.description, ns="http://www.meemoo.be/ns")
+    results = []
+    for i, rec in enumerate(mh_records):
+        # Get some metadata for this record
+        rec_meta = get_rec_meta(rec)
+        if not args.dryrun and q_value in from_cache:
+            try:
+                rec = revalidate_mh_record(rec, rec_meta, rate_limiter)
+            except MediaHavenException as e:
+                err_string = f"ERROR: Could not revalidate cached record {rec_meta.FragmentId}: Status_code={e.status_code}, msg={error_msg_from(e)}"
+                print(err_string)
+                if e.status_code in (403, 404):
+                    # Gone (or no longer ours): search again next time
+                    cache.invalidate(run_meta.or_id, run_meta.id_col, q_value)
+                results.append((error_report_node(rec_meta, q_value, csv_row, err_string), None))
+                metrics.record_done("ERROR", error_from(e))
+                continue
+            if rec is not mh_records[i]:
+                # Cache the current version, for the next run
+                mh_records[i] = rec
+                cache.put(run_meta.or_id, run_meta.id_col, q_value, mh_records)
+        valid = "true" # Assume success
+        plan_entry = None
+        # We create one report-node for every MH-record we might find for
+        # the given identifier
+        report_node = xvrl.create_ReportNode(rec_meta)
+        # Reduce and transform the record (CPU-stage)
+        with metrics.stage("transform"):
+            mh_original_record, mh_update_object, err_string, unchanged = run_cpu_stage(
+                cpu_pool, transform_record, etree.tostring(rec), row, run_meta.data_cols, run_meta.reason
             )
-            xvrl_report_doc.add(report_node)
+        status, error = "DONE", None
+        # Add the same row-based update transformations to every report
+        # for every record returned by MediaHaven.
+        report_node.metadata.supplemental.add(row_transfos)
+        report_node.metadata.supplemental.add(csv_row)
+        report_node.metadata.supplemental.add(
+            xvrl.Node("MhOriginalRecord", data=mh_original_record, ns="http://www.meemoo.be/ns", cdata=True)
+        )
+        report_node.metadata.supplemental.add(
+            xvrl.Node("IdentifierValue", data=q_value, ns="http://www.meemoo.be/ns")
+        )
+        if err_string:
+            print(err_string)
             detection = xvrl.Node("detection",
                 attribs={"severity": "error"}
             )
@@ -156,106 +236,225 @@ def proces_csv(args):
             report_node.add(detection)
             mh_update_object = "N/A"
             valid = "false"
-            continue
-        # Make list of Transformations while filtering out the identifier-column
-        # and any possible None-columns at the end.
-        # The transformations on this CSV-row need to be applied to all MH-records
-        # that might get returned for this idenifier and value.
-        dyn_ts = transformations_from_csv_row(row, run_meta.data_cols)
-        all_ts = merge_transformations_lists([add_default_licenses] + dyn_ts + default_transformations)
-        row_transfos = xvrl.Node("DynamicTransformations", data=str(dyn_ts), ns="http://www.meemoo.be/ns")
-        for rec in mh_records:
-            # Get some metadata for this record
-            rec_meta = get_rec_meta(rec)
-            valid = "true" # Assume success
-            # We create one report-node for every MH-record we might find for
-            # the given identifier
-            report_node = xvrl.create_ReportNode(rec_meta)
-            # Add the same row-based update transformations to every report
-            # for every record returned by MediaHaven.
-            report_node.metadata.supplemental.add(row_transfos)
-            report_node.metadata.supplemental.add(
-                xvrl.Node("CsvRow", data=pformat(row), ns="http://www.meemoo.be/ns")
-            )
-            report_node.metadata.supplemental.add(
-                xvrl.Node("MhOriginalRecord", data=xvrl.reduceSidecar(rec), ns="http://www.meemoo.be/ns", cdata=True)
-            )
-            report_node.metadata.supplemental.add(
-                xvrl.Node("IdentifierValue", data=q_value, ns="http://www.meemoo.be/ns")
-            )
-            try:
-                # The transform-fn accepts either a string (file of file-like object)
-                # or an XML-document (this an lxml.etree._ElementTree)
-                mh_update_object = transform(
-                    input_file_path=etree.ElementTree(rec),
-                    static_values={"Reason": run_meta.reason},
-                    transformations=all_ts,
-                    out_format=MhFormat.MH_UPDATEOBJECT,
+            status, error = "ERROR", "MH_REC_UNCORRECTABLE"
+        else:
+            print(f"OK: {row[run_meta.id_col]}")
+            # ~ print(mh_update_object)
+            if not unchanged:
+                plan_entry = PlanEntry(
+                    rec_meta.FragmentId, q_value, xpath.last_modified(rec), mh_update_object,
+                    fingerprint(mh_original_record),
                 )
-            except ValueError as e:
-                err_string = f'Could not properly transform/clean record: {e}'
-                print(err_string)
+            if unchanged:
+                # Nothing to update: MediaHaven already has these values
+                print(f"Unchanged: no update needed for {rec_meta.FragmentId}")
+                status = "UNCHANGED"
                 detection = xvrl.Node("detection",
-                    attribs={"severity": "error"}
+                    attribs={"severity": "info"}
                 )
                 msg = xvrl.Node("message",
-                    attribs={"xmllang": "en"}, data=err_string
+                    attribs={"xmllang": "en"}, data=f"Unchanged: no update needed for item: {q_value}"
                 )
                 detection.add(msg)
                 report_node.add(detection)
-                mh_update_object = "N/A"
-                valid = "false"
-            else:
-                print(f"OK: {row[run_meta.id_col]}")
-                # ~ print(mh_update_object)
-                if not args.dryrun:
-                    # Update item in MediaHaven
-                    print(f"Performing update for item: {q_param}:{q_value} => FragmentId:{rec_meta.FragmentId}")
-                    try:
-                        mh_resp = mh_client.records.update(rec_meta.FragmentId, xml=mh_update_object)
-                        # ~ raise MediaHavenException(status_code=500, message="Something wrong...")
-                    except MediaHavenException as e:
-                        err_string = error_msg_from(e)
-                        error = error_from(e)
-                        full_err_string = f"Status_code={e.status_code}, status_msg={error}, msg={err_string}"
-                        print(full_err_string)
-                        detection = xvrl.Node("detection",
-                            attribs={"severity": "error"}
-                        )
-                        msg = xvrl.Node("message",
-                            attribs={"xmllang": "en"}, data=full_err_string
-                        )
-                        detection.add(msg)
-                        report_node.add(detection)
-                        valid = "false"
-                    else:
-                        print(f"Succesfully updated {rec_meta.FragmentId}.")
-                        detection = xvrl.Node("detection",
-                            attribs={"severity": "info"}
-                        )
-                        msg = xvrl.Node("message",
-                            attribs={"xmllang": "en"}, data=f"Succesfully updated item: {q_value}"
-                        )
-                        detection.add(msg)
-                        report_node.add(detection)
+            elif not args.dryrun and rec_meta.FragmentId in journal.done_records:
+                print(f"Already updated in a previous run: {rec_meta.FragmentId}")
+                status = "SKIPPED"
+                detection = xvrl.Node("detection",
+                    attribs={"severity": "info"}
+                )
+                msg = xvrl.Node("message",
+                    attribs={"xmllang": "en"}, data=f"Already updated item in a previous run: {q_value}"
+                )
+                detection.add(msg)
+                report_node.add(detection)
+            elif not args.dryrun:
+                # Update item in MediaHaven
+                print(f"Performing update for item: {q_param}:{q_value} => FragmentId:{rec_meta.FragmentId}")
+                try:
+                    with metrics.stage("mh_update"):
+                        mh_resp = rate_limiter.call(mh_client.records.update, rec_meta.FragmentId, xml=mh_update_object)
+                    # ~ raise MediaHavenException(status_code=500, message="Something wrong...")
+                except MediaHavenException as e:
+                    err_string = error_msg_from(e)
+                    error = error_from(e)
+                    full_err_string = f"Status_code={e.status_code}, status_msg={error}, msg={err_string}"
+                    print(full_err_string)
+                    detection = xvrl.Node("detection",
+                        attribs={"severity": "error"}
+                    )
+                    msg = xvrl.Node("message",
+                        attribs={"xmllang": "en"}, data=full_err_string
+                    )
+                    detection.add(msg)
+                    report_node.add(detection)
+                    valid = "false"
+                    status = "ERROR"
                 else:
-                    print(f"Dryrun: not actualy performing update for item: {q_param}:{q_value}")
-            # Add the validation/traonsformation report node
-            report_node.digest.attribs = {"valid": valid}
-            report_node.metadata.supplemental.add(
-                xvrl.Node("MhUpdateRecord", data=mh_update_object, ns="http://www.meemoo.be/ns", cdata=True)
-            )
-            xvrl_report_doc.add(report_node)
-    # Add end-time
-    end_time = dt.now().astimezone()
+                    print(f"Succesfully updated {rec_meta.FragmentId}.")
+                    journal.record_done(row_num, rec_meta.FragmentId)
+                    detection = xvrl.Node("detection",
+                        attribs={"severity": "info"}
+                    )
+                    msg = xvrl.Node("message",
+                        attribs={"xmllang": "en"}, data=f"Succesfully updated item: {q_value}"
+                    )
+                    detection.add(msg)
+                    report_node.add(detection)
+            else:
+                print(f"Dryrun: not actualy performing update for item: {q_param}:{q_value}")
+                status = "DRYRUN"
+        # Add the validation/traonsformation report node
+        report_node.digest.attribs = {"valid": valid}
+        report_node.metadata.supplemental.add(
+            xvrl.Node("MhUpdateRecord", data=mh_update_object, ns="http://www.meemoo.be/ns", cdata=True)
+        )
+        results.append((report_node, plan_entry))
+        metrics.record_done(status, error)
+    return results
+
+
+def proces_csv(args):
+    # Init vars from args
+    csv_filepath = args.input_file
+    or_id = args.or_id
+    reason = args.reason
+    rate_limiter = RateLimiter(args.rate)
+    cache = SidecarCache(
+        args.cache_dir, ttl=args.cache_ttl * 3600, max_size=args.cache_max_size * 1024**2
+    ) if args.cache_dir else None
+    csv_parsed = csv.CsvParser(csv_filepath, delimiter=args.csv_delimiter)
+    #
+    run_meta = UpdateRun(reason, csv_parsed.id_col, csv_parsed.data_cols, or_id)
+    # Perform some basic checks first
+    try:
+        csv_parsed.validate()
+    except csv.CsvInvalidError as e:
+        print(f"CsvInvalidError: {e}")
+        exit(1)
+    xvrl_report_filename = "./reports/xvrl_report.xml"
+    # A dry-run also writes the update plan, to be applied with `plan-cli.py`
+    update_plan_filename = "./reports/update_plan.jsonl"
+    # Every finished row (and updated record) is checkpointed in the journal
+    journal = Journal("./reports/journal.jsonl", {
+        "input_file": abspath(csv_filepath),
+        "or_id": or_id,
+        "reason": reason,
+        "dryrun": args.dryrun,
+    }, resume=args.resume)
+    if args.resume and exists(xvrl_report_filename):
+        # Keep the report of the previous, interrupted, run
+        n = 1
+        while exists(f"./reports/xvrl_report.{n}.xml"):
+            n += 1
+        rename(xvrl_report_filename, f"./reports/xvrl_report.{n}.xml")
+        print(f"Previous XVRL Report moved to: ./reports/xvrl_report.{n}.xml")
+    # Start a XVRL Report Doc
+    xvrl_report_doc = xvrl.create_XVRLReportsDoc(run_meta)
+    start_time = dt.now().astimezone()
     xvrl_report_doc.metadata.supplemental.add(
-        xvrl.Node("EndTime", data=end_time.replace(microsecond=0).isoformat(), ns="http://www.meemoo.be/ns")
+        xvrl.Node("StartTime", data=start_time.replace(microsecond=0).isoformat(), ns="http://www.meemoo.be/ns")
     )
-    # Finally, write the XVRL Report to file
-    xvrl_report_filename = "./reports/xvrl_report.xml"
-    tree = xvrl_report_doc.to_Etree_doc().write(xvrl_report_filename, encoding='UTF-8', pretty_print=True, xml_declaration=True)
+    # Staged pipeline: lookups and updates run on a thread pool, transforms
+    # on a process pool. Rows are handed to the (ordered) report sink in CSV
+    # order, and at most `max_pending` rows are in flight (backpressure).
+    io_pool = ThreadPoolExecutor(max_workers=args.concurrency)
+    # Workers are spawned, not forked: the pool is used from multiple threads
+    cpu_pool = ProcessPoolExecutor(
+        max_workers=args.concurrency, mp_context=multiprocessing.get_context("spawn")
+    ) if args.concurrency > 1 else None
+    max_pending = 4 * args.concurrency
+    pending = deque()
+    html_filename = "./reports/report.html"
+    html_abspath = None
+    # Reports are written to disk as soon as they are finished
+    with (
+        io_pool,
+        journal,
+        xvrl.XVRLReportWriter(xvrl_report_filename, xvrl_report_doc) as report_writer,
+        UpdatePlanWriter(update_plan_filename, append=args.resume) if args.dryrun else nullcontext() as plan_writer,
+        # Optionally, the html-report is rendered (per chunk) during the run
+        ShardedReportRenderer(
+            html_filename, args.report_chunk_size, args.report_workers, incremental=True
+        ) if args.report_incremental else nullcontext() as renderer,
+    ):
+        if renderer:
+            renderer.add_metadata(xvrl_report_doc.metadata.to_Etree())
+        if journal.failed_rows:
+            print(f"Retrying {len(journal.failed_rows)} row(s) that did not finish as DONE.")
+        if journal.next_row:
+            print(f"Resuming from row {journal.next_row + 2} (header being row 1).")
+        # The failed rows first, then the rows that were not handled yet
+        csv_lines = chain(
+            ((row_num, row) for row_num in journal.failed_rows for row in csv_parsed.iterator(row_num, row_num + 1)),
+            enumerate(csv_parsed.iterator(journal.next_row), journal.next_row),
+        )
+        # For the run's digest
+        report_counts = {"reports": 0, "invalid": 0}
+        def drain(max_size: int):
+            while len(pending) > max_size:
+                row_num, row, future = pending.popleft()
+                q_value = row[run_meta.id_col]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # Only this row fails: the run goes on
+                    err_string = f"ERROR: Unexpected error handling {run_meta.id_col}:{q_value}: {error_msg_from(e)}"
+                    print(err_string)
+                    metrics.record_done("ERROR", error_from(e))
+                    csv_row = xvrl.Node("CsvRow", data=pformat(row), ns="http://www.meemoo.be/ns")
+                    results = [(error_report_node(MHRecordMeta(), q_value, csv_row, err_string), None)]
+                with metrics.stage("report_write"):
+                    for report_node, plan_entry in results:
+                        report_el = report_writer.write(report_node)
+                        if renderer:
+                            renderer.add(report_el)
+                        if plan_writer and plan_entry:
+                            plan_writer.write(plan_entry)
+                invalid = sum(1 for node, _ in results if node.digest.attribs["valid"] != "true")
+                report_counts["reports"] += len(results)
+                report_counts["invalid"] += invalid
+                valid = not invalid
+                journal.row_done(row_num, q_value, "DONE" if valid else "ERROR")
+        try:
+            for chunk in chunked(csv_lines, args.batch_size):
+                rows = [row for _, row in chunk]
+                lookup = io_pool.submit(lookup_mh_records, rows, run_meta, rate_limiter, cache, args.dryrun)
+                for row_num, row in chunk:
+                    # First, skip the first line if it has no ID-value
+                    # Assume the first non-header row contains the "human fieldnames".
+                    if not row[run_meta.id_col]:
+                        print(f"Skipping first line: ID-value for {run_meta.id_col} is empty.")
+                        continue
+                    pending.append((row_num, row, io_pool.submit(
+                        profiler.call, row[run_meta.id_col], process_row, row_num, row, lookup, run_meta, args, rate_limiter, cpu_pool, journal, cache
+                    )))
+                    drain(max_pending)
+            drain(0)
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            if cpu_pool is not None:
+                cpu_pool.shutdown(cancel_futures=True)
+        # Add the digest, with the end-time
+        end_time = dt.now().astimezone()
+        digest = report_writer.write(
+            xvrl.create_DigestNode(end_time, report_counts["reports"], report_counts["invalid"])
+        )
+        if renderer:
+            renderer.add_digest(digest)
+            with metrics.stage("html_report"):
+                html_abspath = renderer.close()
+    if cache is not None:
+        cache.close()
     print(f"XVRL Report written to: {xvrl_report_filename}")
-    html_abspath = xvrl.writeXVRL2html(xvrl_report_filename, "./reports/report.html")
+    if args.dryrun:
+        print(f"Update plan written to: {update_plan_filename}")
+    if html_abspath is None:
+        with metrics.stage("html_report"):
+            html_abspath = render_xvrl(
+                xvrl_report_filename, html_filename, args.report_chunk_size, args.report_workers
+            )
     print(f"Html Report written to: {html_abspath}")
 
 
@@ -291,6 +490,99 @@ def main():
         default=",",
         help="""Provide a custom delimiter to parse the CSV-file. (default: ',')""",
     )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        required=False,
+        default=50,
+        help="""Number of identifier values to look up in MediaHaven in one search. (default: 50)""",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        required=False,
+        default=1,
+        help="""Number of rows to handle concurrently: lookups and updates run on as many threads, transformations on as many processes. (default: 1)""",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        required=False,
+        default=None,
+        help="""Directory for a local cache of MediaHaven search results, reused by subsequent runs. Records served from the cache are revalidated against MediaHaven before a real update, and values cached as not found are searched again. (default: no cache)""",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        required=False,
+        default=24,
+        help="""Number of hours after which cached search results expire. (default: 24)""",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        required=False,
+        default=512,
+        help="""Maximum size of the local cache in MB: the oldest entries are evicted first. (default: 512)""",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        required=False,
+        default=None,
+        help="""Target number of requests per second to MediaHaven: backs off automatically when throttled. (default: unlimited)""",
+    )
+    parser.add_argument(
+        "--report-chunk-size",
+        type=int,
+        required=False,
+        default=1000,
+        help="""Number of records per page of the html-report: the pages are rendered in parallel. (default: 1000)""",
+    )
+    parser.add_argument(
+        "--report-workers",
+        type=int,
+        required=False,
+        default=os.cpu_count() or 1,
+        help="""Number of processes rendering the html-report. (default: the number of CPUs)""",
+    )
+    parser.add_argument(
+        "--report-incremental",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="""Render the html-report during the run, a page at a time, instead of at the end. (default: False)""",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        required=False,
+        default=None,
+        help="""Expose metrics in the Prometheus text format on http://127.0.0.1:PORT/metrics. (optional)""",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        required=False,
+        default=None,
+        help="""Periodically write metrics in the Prometheus text format to this file. (optional)""",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        required=False,
+        default=None,
+        help="""Profile the run: writes cProfile stats to PROFILE.pstats and a trace of the sampled rows to PROFILE.trace.json (Chrome trace format, eg. for speedscope). (optional)""",
+    )
+    parser.add_argument(
+        "--profile-every",
+        type=int,
+        required=False,
+        default=1,
+        help="""Only profile every Nth row. (default: 1)""",
+    )
     parser.add_argument(
         "--dryrun",
         type=bool,
@@ -298,6 +590,13 @@ def main():
         default=True,
         help="""Perform a dry-run. Use the `--no-dryrun` command line argument to disable a dry-run, ie., to actually perform the update against MediaHaven.""",
     )
+    parser.add_argument(
+        "--resume",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="""Resume an interrupted run from its journal (./reports/journal.jsonl): rows that finished as DONE are skipped, rows that failed are retried and records that were already updated are not updated again. The reports (XVRL and html) of the resumed run only cover the rows handled in it: the XVRL-report of the previous run is kept as ./reports/xvrl_report.N.xml.""",
+    )
     # ~ parser.add_argument(
         # ~ "-c",
         # ~ "--case",
@@ -311,10 +610,22 @@ def main():
 
     args = parser.parse_args()
 
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print(f"Metrics exposed on: http://127.0.0.1:{args.metrics_port}/metrics")
+    if args.metrics_file:
+        metrics.write_periodically(args.metrics_file)
+    if args.profile:
+        profiler.start(args.profile, args.profile_every)
     try:
         proces_csv(args)
     except ValueError as e:
         print(f'Some error: {e}')
+    finally:
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+        profiler.stop()
+        print(metrics.summary())
 
 
 if __name__ == "__main__":
@@ -5,19 +5,25 @@ CLI interface to the `mh-mtd-updater` with DB as input.
 """
 
 import time
-import datetime
 import argparse
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Any
 from io import BytesIO
-from services.db import DatabaseService, RecordStatus
+from services.db import DatabaseService, RecordStatus, ResultWriter
+from services.ratelimit import RateLimiter
+from services.metrics import metrics
+from services.profiling import profiler
+from services.mh_client import LazyMediaHaven, load_config
+from services.progress import ProgressReporter
+from services.storage import StorageMode, store_original_metadata
+from helpers import error_from, error_msg_from
 import logging
 
-from viaa.configuration import ConfigParser
 # ~ from viaa.observability import logging
 
-from mediahaven import MediaHaven
 from mediahaven.mediahaven import MediaHavenException, AcceptFormat
-from mediahaven.oauth2 import ROPCGrant
 
 from meemoo_mtd.mediahaven_config import MhFormat
 from meemoo_mtd.transformations import (
@@ -26,10 +32,6 @@ from meemoo_mtd.transformations import (
 )
 
 
-# Init the config
-configParser = ConfigParser()
-config = configParser.app_cfg
-
 # Configure logging
 log = logging.getLogger(__name__)
 logging.basicConfig(
@@ -40,77 +42,36 @@ logging.basicConfig(
 # Alternatively, struct logging: from viaa.observability import logging
 # ~ log = logging.get_logger(__name__, config=configParser)
 
-mh_config = config["mediahaven"]
-grant = ROPCGrant(
-    mh_config["host"],
-    mh_config["client_id"],
-    mh_config["client_secret"],
-)
-grant.request_token(mh_config["username"], mh_config["password"])
-mh_client = MediaHaven(mh_config["host"], grant)
-
-
-def error_from(error: Any) -> str:
-    """Turn any kind of error we might encounter into a short but intelligible
-    string.
-    Eg. MH-404 response ⇒ `MH_REC_NOTFOUND`"""
-    # The 'MH'-cases
-    if isinstance(error, MediaHavenException):
-        if error.status_code == 400:
-            return "MH_BAD_REQUEST"
-        elif error.status_code in (401, 403):
-            return "MH_UNAUTHORIZED"
-        elif error.status_code == 404:
-            return "MH_REC_NOTFOUND"
-        elif error.status_code == 429:
-            return "MH_TOO_MANY_REQUESTS"
-        elif error.status_code == 500:
-            return "MH_SERVER_ERROR"
-        else:
-            return "MH_UNKOWN_ERROR"
-    elif isinstance(error, ValueError):
-        return "MH_REC_UNCORRECTABLE"
-    # The Generic unknown case
-    else:
-        return "UNKOWN_ERROR"
-
-
-def error_msg_from(error: Any) -> str:
-    """Retrieve the `message`-attr from an error, or something else if it's
-    not present."""
-    if hasattr(error, "msg"):
-        return error.msg
-    elif hasattr(error, "message"):
-        return error.message
-    elif hasattr(error, "error_msg"):
-        return error.error_message
-    else:
-        return str(error)
+# The client is only created (and its token requested) on first use
+mh_client = LazyMediaHaven()
 
 
-def process_item(item, database, reason: str):
+def process_item(item, result_writer: ResultWriter, reason: str, rate_limiter: RateLimiter, storage: StorageMode):
     log.info(f'Processing "{item.fragment_id}"...')
     # Get item from MediaHaven and turn it into a bytes-object
     try:
-        mh_record_xml = mh_client.records.get(
-            item.fragment_id, accept_format=AcceptFormat.XML
-        )
+        with metrics.stage("mh_get"):
+            mh_record_xml = rate_limiter.call(
+                mh_client.records.get, item.fragment_id, accept_format=AcceptFormat.XML
+            )
     except MediaHavenException as e:
         log.warning("Status_code=%s, msg=%s", e.status_code, error_msg_from(e))
         item.error = error_from(e)
         item.error_msg = error_msg_from(e)
         item.status = RecordStatus.ERROR
     else:
-        item.original_metadata = mh_record_xml.raw_response
+        with metrics.stage("store"):
+            store_original_metadata(item, mh_record_xml.raw_response, storage)
         mh_rec_as_bytes = BytesIO(mh_record_xml.raw_response.encode("utf-8"))
         # Perform transformations
         try:
-            mh_update_object = transform(
-                input_file_path=mh_rec_as_bytes,
-                static_values={"Reason": reason},
-                transformations=default_transformations,
-                out_format=MhFormat.MH_UPDATEOBJECT,
-            )
+            with metrics.stage("transform"):
+                mh_update_object = transform(
+                    input_file_path=mh_rec_as_bytes,
+                    static_values={"Reason": reason},
+                    transformations=default_transformations,
+                    out_format=MhFormat.MH_UPDATEOBJECT,
+                )
         except ValueError as e:
             log.warning(
                 'Could not properly transform/clean "%s": %s', item.fragment_id, e
@@ -123,10 +84,13 @@ def process_item(item, database, reason: str):
             # needed or perfomed.
             if mh_update_object:
                 item.update_object = mh_update_object
-                print(mh_update_object)
+                log.debug("UpdateObject for %s: %s", item.fragment_id, mh_update_object)
                 # Update item in MediaHaven
                 try:
-                    mh_resp = mh_client.records.update(item.fragment_id, xml=mh_update_object)
+                    with metrics.stage("mh_update"):
+                        mh_resp = rate_limiter.call(
+                            mh_client.records.update, item.fragment_id, xml=mh_update_object
+                        )
                 except MediaHavenException as e:
                     log.warning(
                         "Status_code=%s, msg=%s", e.status_code, error_msg_from(e)
@@ -140,15 +104,75 @@ def process_item(item, database, reason: str):
             else:
                 # None returned
                 item.status = RecordStatus.DONE
-    # Save state and result to the database
-    _ = database.update_with_result(item)
+    # Save state and result to the database (buffered)
+    with metrics.stage("db_write"):
+        result_writer.add(item)
+    metrics.record_done(item.status.value, item.error)
 
 
-def calculate_time_to_process(nr_of_items, limit, sleep_secs) -> str:
-    """"""
-    nr_of_items = nr_of_items if not limit else limit
-    total_secs = nr_of_items * sleep_secs if sleep_secs else nr_of_items
-    return str(datetime.timedelta(seconds=total_secs))
+def process_items(database, args) -> int:
+    """Claim items in batches and process them on a bounded pool of worker
+    threads. The `MediaHaven`-client and the database's connection pool are
+    shared by all workers.
+    On Ctrl-C, items that were claimed but not yet started are handed back
+    (status TODO) while running items are allowed to finish.
+    Returns the number of processed items."""
+    rate_limiter = RateLimiter(args.rate)
+    result_writer = ResultWriter(database, max_size=args.flush_size)
+    claimed = deque()
+    pending = {}
+    submitted = processed = 0
+    exhausted = False
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        # On exit, the workers are waited for before the results are flushed
+        with result_writer, executor:
+            try:
+                while True:
+                    # Keep every worker busy, but never claim beyond the limit
+                    while not exhausted and len(pending) < args.workers:
+                        if args.limit and submitted >= args.limit:
+                            print("Stopping because limit has been reached...")
+                            exhausted = True
+                            break
+                        if not claimed:
+                            batch_size = args.batch_size
+                            if args.limit:
+                                batch_size = min(batch_size, args.limit - submitted)
+                            with metrics.stage("db_claim"):
+                                claimed.extend(database.claim_items_to_process(batch_size, args.jira_ticket))
+                        if not claimed:
+                            print(f"""No more items with status TODO in '{database.table}'.""")
+                            exhausted = True
+                            break
+                        item = claimed.popleft()
+                        pending[executor.submit(
+                            profiler.call, item.fragment_id, process_item, item, result_writer, args.reason, rate_limiter, args.storage
+                        )] = item
+                        submitted += 1
+                        if args.sleep:
+                            with metrics.stage("sleep"):
+                                time.sleep(args.sleep)
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        item = pending.pop(future)
+                        processed += 1
+                        if future.exception():
+                            log.error('Unexpected error processing "%s": %s', item.fragment_id, future.exception())
+                            database.update_db_status(item.fragment_id, RecordStatus.ERROR.value)
+            except KeyboardInterrupt:
+                print("Interrupted: waiting for running items to finish...")
+                for future, item in pending.items():
+                    if future.cancel():
+                        claimed.append(item)
+                    else:
+                        processed += 1
+    finally:
+        # Also when the last results could not be written
+        database.release_items([item.fragment_id for item in claimed])
+    return processed
 
 
 def main():
@@ -161,6 +185,13 @@ def main():
         required=True,
         help="The reason to be provided for the updates that will be performed. Usually a reference to a Jira-ticket.",
     )
+    parser.add_argument(
+        "-t",
+        "--jira-ticket",
+        type=str,
+        default=None,
+        help="Only process items of this jira_ticket (optional: defaults to all TODO items, per ticket)",
+    )
     parser.add_argument(
         "-n",
         "--limit",
@@ -175,36 +206,118 @@ def main():
         default=0,
         help="Number of seconds to wait between each item (optional: defaults to 0)",
     )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Number of items to claim from the database at once (optional: defaults to 100)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of items to process concurrently (optional: defaults to 1)",
+    )
+    parser.add_argument(
+        "--flush-size",
+        type=int,
+        default=50,
+        help="Number of results to buffer before writing them to the database at once (optional: defaults to 50)",
+    )
+    parser.add_argument(
+        "--storage",
+        type=StorageMode,
+        choices=list(StorageMode),
+        default=StorageMode.FULL,
+        help="How to store the original metadata: full, reduced (Descriptive and Dynamic only), compressed or only its hash (optional: defaults to full)",
+    )
+    parser.add_argument(
+        "--release-stale",
+        type=float,
+        default=None,
+        help="At start, hand items that have been IN_PROGRESS for more than this many minutes back to the queue, eg. after a crash (optional)",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=30.0,
+        help="Number of seconds between progress reports (done/error/remaining and ETA), 0 to disable (optional: defaults to 30)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Expose metrics in the Prometheus text format on http://127.0.0.1:PORT/metrics (optional)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="Periodically write metrics in the Prometheus text format to this file (optional)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Profile the run: writes cProfile stats to PROFILE.pstats and a trace of the sampled items to PROFILE.trace.json (optional)",
+    )
+    parser.add_argument(
+        "--profile-every",
+        type=int,
+        default=1,
+        help="Only profile every Nth item (optional: defaults to 1)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="Target number of requests per second to MediaHaven: backs off automatically when throttled (optional: defaults to unlimited)",
+    )
 
     args = parser.parse_args()
+    config = load_config()
     db_conf = config["database"]
     print(f"""Will connect to '{db_conf["table"]}' on '{db_conf["host"]}'.""")
 
-    database = DatabaseService(config, db_conf["table"])
+    # One pooled connection per worker, plus one for claiming, one for the
+    # result writer's periodic flush and one for the progress reporter
+    database = DatabaseService(config, db_conf["table"], pool_size=max(4, args.workers + 3))
 
-    nr_of_items = database.count_items_to_process()
-    time_to_process = calculate_time_to_process(nr_of_items, args.limit, args.sleep)
-    print(f"Items to process: {nr_of_items} (status=TODO, with limit={args.limit})")
-    print(f"Will take approx.: {time_to_process} (with sleeptime={args.sleep})")
+    if args.storage.needs_compact_columns and not database.compact_columns:
+        parser.error(f"--storage {args.storage.value} needs migrations/003_compact_metadata.sql")
+    if args.release_stale:
+        released = database.release_stale_items(args.release_stale)
+        print(f"Released {released} stale item(s) (IN_PROGRESS for more than {args.release_stale} minutes).")
+    nr_of_items = database.count_items_to_process(args.jira_ticket)
+    if args.limit:
+        nr_of_items = min(nr_of_items, args.limit)
+    print(f"Items to process: {nr_of_items} (status=TODO, jira_ticket={args.jira_ticket}, limit={args.limit})")
 
-    processed_count = 0
-    while True:
-        item = database.get_item_to_process()
-
-        if not item:
-            print(f"""No more items with status TODO in '{db_conf["table"]}'.""")
-            break
-
-        process_item(item, database, args.reason)
-        processed_count += 1
-
-        if args.limit and processed_count >= args.limit:
-            print("Stopping because limit has been reached...")
-            break
-
-        time.sleep(args.sleep)
-
-    print(f"Processed {processed_count} item(s).")
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print(f"Metrics exposed on: http://127.0.0.1:{args.metrics_port}/metrics")
+    if args.metrics_file:
+        metrics.write_periodically(args.metrics_file)
+    if args.profile:
+        profiler.start(args.profile, args.profile_every)
+    progress = ProgressReporter(
+        database,
+        interval=args.progress_interval,
+        limit=args.limit,
+        jira_ticket=args.jira_ticket,
+        processed=lambda: metrics.records_done,
+    ) if args.progress_interval else nullcontext()
+    try:
+        with progress:
+            processed_count = process_items(database, args)
+        print(f"Processed {processed_count} item(s).")
+    finally:
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+        profiler.stop()
+        print(metrics.summary())
 
 
 if __name__ == "__main__":
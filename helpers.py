@@ -6,7 +6,10 @@ Some models and helper-funtions.
 
 #
 # Std
-from typing import List, NamedTuple
+import math
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Tuple
 # 3d
 from lxml import etree
 # Libs
@@ -24,9 +27,13 @@ from meemoo_mtd.transformations import (
     default_transformations,
     merge_transformations_lists,
     transformation_from_dict,
+    add_default_licenses,
 )
 # Local
 from services.xvrl import *
+from services import xpath
+from services.compare import is_noop_update
+from services.xpath import SIDECAR_XPATH, FID_XPATH
 
 
 # Some useful things
@@ -53,14 +60,58 @@ class UpdateRun(NamedTuple):
     or_id: str
     description: str = "Een beschrijving van de run"
 
-# Some constants
-SIDECAR_XPATH = '/Response/Results/mhs:Sidecar'
-FID_XPATH = 'mhs:Sidecar/mhs:Internal/mh:FragmentId'
+def error_from(error: Any) -> str:
+    """Turn any kind of error we might encounter into a short but intelligible
+    string.
+    Eg. MH-404 response ⇒ `MH_REC_NOTFOUND`"""
+    # The 'MH'-cases
+    if isinstance(error, MediaHavenException):
+        if error.status_code == 400:
+            return "MH_BAD_REQUEST"
+        elif error.status_code in (401, 403):
+            return "MH_UNAUTHORIZED"
+        elif error.status_code == 404:
+            return "MH_REC_NOTFOUND"
+        elif error.status_code == 429:
+            return "MH_TOO_MANY_REQUESTS"
+        elif error.status_code == 500:
+            return "MH_SERVER_ERROR"
+        else:
+            return "MH_UNKOWN_ERROR"
+    elif isinstance(error, ValueError):
+        return "MH_REC_UNCORRECTABLE"
+    # The Generic unknown case
+    else:
+        return "UNKOWN_ERROR"
+
+
+def error_msg_from(error: Any) -> str:
+    """Retrieve the `message`-attr from an error, or something else if it's
+    not present."""
+    if hasattr(error, "msg"):
+        return error.msg
+    elif hasattr(error, "message"):
+        return error.message
+    elif hasattr(error, "error_msg"):
+        return error.error_message
+    else:
+        return str(error)
+
 
 def construct_query_string(q_dict: dict):
     l = [f'+({k}:"{v}")' for k, v in q_dict.items()]
     return " ".join(l)
 
+def quote_query_value(value: str) -> str:
+    """Escape a value to be used within double quotes in a query."""
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    """Split an iterable into lists of (at most) `size` items."""
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
 def list_from_str(string: str, sep: str = ",") -> list:
     """Evaluate a string with a certain seperator to a list."""
     return string.split(sep)
@@ -84,24 +135,126 @@ def transformations_from_csv_row(row: dict, data_cols: list) -> List[Transformat
     return t_list
     #return [Transformation(target=k, transformers=v if not k == "Dynamic.dc_rights_licenses" else [v]) for k, v in row.items() if k in data_cols]
 
+
+class TransformationPlan(NamedTuple):
+    """The transformations for a CSV-row, merged with the default ones.
+    Immutable, so that one plan can be shared by all rows with the same
+    values (and by the threads handling them)."""
+    dynamic: tuple  # The transformations from the CSV-row
+    merged: tuple  # The dynamic transformations, merged with the default ones
+    description: str  # `str` of the dynamic transformations, for the report
+
+
+def transformation_plan_key(row: dict, data_cols: list) -> tuple:
+    """The columns and values of a CSV-row that determine its transformations
+    (in the row's column order)."""
+    return tuple((k, v) for k, v in row.items() if k == "Dynamic.dc_rights_licenses" or k in data_cols)
+
+
+@lru_cache(maxsize=4096)
+def _transformation_plan(key: tuple) -> TransformationPlan:
+    dyn_ts = transformations_from_csv_row(dict(key), [k for k, _ in key])
+    all_ts = merge_transformations_lists([add_default_licenses] + dyn_ts + default_transformations)
+    return TransformationPlan(tuple(dyn_ts), tuple(all_ts), str(dyn_ts))
+
+
+def transformation_plan(row: dict, data_cols: list) -> TransformationPlan:
+    """The (cached) transformation plan for a CSV-row: partner CSVs often
+    repeat the same values (eg. one license) over thousands of rows."""
+    return _transformation_plan(transformation_plan_key(row, data_cols))
+
+def search_mh_records(mh_client, q: str, page_size: int = 100) -> list:
+    """All sidecars found by a search, paging until `TotalNrOfResults` is
+    reached: MediaHaven may return fewer results per page than asked for."""
+    results = []
+    while True:
+        resp = mh_client._get("records", AcceptFormat.XML, q=q, startIndex=len(results), nrOfResults=page_size)
+        doc = etree.fromstring(resp.text.encode("utf-8"))
+        page = xpath.sidecars(doc)
+        results.extend(page)
+        total = xpath.total_nr_of_results(doc)
+        if math.isnan(total):
+            # Without a total, a short page is the last one
+            total = len(results) if len(page) < page_size else math.inf
+        if not page or len(results) >= total:
+            return results
+
+
 # We need to always search within a given CP.
 # Especially for Lukasweb since most items exist in multiple tenants.
 # (deleted items are not returned by default)
 def get_mh_records(mh_client, q_param, q_value, or_id) -> list:
-    or_id_key = "Dynamic.CP_id"
-    q_dict = {or_id_key: or_id, q_param: q_value}
-    q = construct_query_string(q_dict)
-    resp = mh_client._get("records", AcceptFormat.XML, q=q)
+    q = f'+(Dynamic.CP_id:"{quote_query_value(or_id)}") +({q_param}:"{quote_query_value(q_value)}")'
+    return search_mh_records(mh_client, q)
+
+
+def match_key(value: str) -> str:
+    """Key to map search results back to the searched values: the search may
+    normalise case and whitespace, so they are ignored."""
+    return " ".join(value.split()).casefold()
+
+
+def get_mh_records_batch(mh_client, q_param, q_values: list, or_id, page_size: int = 100) -> Tuple[Dict[str, list], int]:
+    """Look up multiple identifier values within one CP in one search: the
+    values are OR'ed in one clause. All result pages are fetched and the
+    sidecars are mapped back to the value(s) they match on `q_param`.
+    Values that match nothing map to an empty list.
+    Returns the sidecars per value and the number of sidecars that could not
+    be mapped back to any value: when there are any, the values without
+    results should be looked up one by one (`get_mh_records`)."""
+    found = {v: [] for v in q_values}
+    by_key = {}
+    for v in found:
+        by_key.setdefault(match_key(v), []).append(v)
+    or_clause = " ".join(f'{q_param}:"{quote_query_value(v)}"' for v in found)
+    q = f'+(Dynamic.CP_id:"{quote_query_value(or_id)}") +({or_clause})'
+    unmatched = 0
+    for sidecar in search_mh_records(mh_client, q, page_size):
+        matched = {v for value in xpath.field_values(q_param)(sidecar) for v in by_key.get(match_key(value), [])}
+        for v in matched:
+            found[v].append(sidecar)
+        if not matched:
+            unmatched += 1
+    return found, unmatched
+
+
+def get_mh_fragment_ids(mh_client, q: str, or_id: str, start_index: int = 0, page_size: int = 100) -> Tuple[List[str], float]:
+    """The FragmentIds of one page of results of a MediaHaven search within
+    one CP, and the `TotalNrOfResults` of the search (NaN when missing).
+    MediaHaven may return fewer results per page than asked for."""
+    q = f'+(Dynamic.CP_id:"{quote_query_value(or_id)}") +({q})'
+    resp = mh_client._get("records", AcceptFormat.XML, q=q, startIndex=start_index, nrOfResults=page_size)
     doc = etree.fromstring(resp.text.encode("utf-8"))
-    return doc.xpath(SIDECAR_XPATH, namespaces=CURRENT_SIDECAR_NAMESPACES)
+    return [xpath.fragment_id(sidecar) for sidecar in xpath.sidecars(doc)], xpath.total_nr_of_results(doc)
 
 
 def get_rec_meta(mh_record) -> MHRecordMeta:
-    """"""
-    return MHRecordMeta(
-        etree.ElementTree(mh_record).xpath("/mhs:Sidecar/mhs:Internal/mh:MediaObjectId/text()", namespaces=CURRENT_SIDECAR_NAMESPACES)[0],      # MediaObjectId
-        etree.ElementTree(mh_record).xpath("/mhs:Sidecar/mhs:Internal/mh:FragmentId/text()", namespaces=CURRENT_SIDECAR_NAMESPACES)[0],         # FragmentId
-        etree.ElementTree(mh_record).xpath("/mhs:Sidecar/mhs:Administrative/mh:ExternalId/text()", namespaces=CURRENT_SIDECAR_NAMESPACES)[0],   # ExternalId
-        etree.ElementTree(mh_record).xpath("/mhs:Sidecar/mhs:Administrative/mh:Type/text()", namespaces=CURRENT_SIDECAR_NAMESPACES)[0],         # Type
-        etree.ElementTree(mh_record).xpath("/mhs:Sidecar/mhs:Internal/mh:PathToKeyframe/text()", namespaces=CURRENT_SIDECAR_NAMESPACES)[0],     # PathToKeyframe
-    )
+    """Get the record-metadata from a sidecar in one pass, defaulting to "N/A"
+    for missing fields (eg. PathToKeyframe for audio)."""
+    return MHRecordMeta(**xpath.rec_meta_fields(mh_record))
+
+
+def transform_record(sidecar_xml: bytes, row: dict, data_cols: list, reason: str) -> tuple:
+    """Reduce and transform one (serialized) MediaHaven-record with the
+    transformations from its CSV-row.
+    Only takes and returns plain values so that it can run in a worker process.
+    Returns a tuple of the reduced original sidecar, the MH-UpdateObject, an
+    error message (either of those two being None) and whether the update
+    would leave the record unchanged."""
+    rec = etree.fromstring(sidecar_xml)
+    mh_original_record = reduceSidecar(sidecar_xml)
+    plan = transformation_plan(row, data_cols)
+    try:
+        # The transform-fn accepts either a string (file of file-like object)
+        # or an XML-document (this an lxml.etree._ElementTree)
+        mh_update_object = transform(
+            input_file_path=etree.ElementTree(rec),
+            static_values={"Reason": reason},
+            # A fresh list: the plan is shared
+            transformations=list(plan.merged),
+            out_format=MhFormat.MH_UPDATEOBJECT,
+        )
+    except ValueError as e:
+        return mh_original_record, None, f'Could not properly transform/clean record: {e}', False
+    unchanged = not mh_update_object or is_noop_update(mh_update_object, rec)
+    return mh_original_record, mh_update_object, None, unchanged
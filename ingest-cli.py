@@ -0,0 +1,152 @@
+"""
+# ingest-cli.py
+
+CLI interface to the `mh-mtd-updater` that fills the database-table (see
+`schema.sql`) with the fragments to be processed by `db-cli.py`, either from a
+file or from a MediaHaven search.
+"""
+
+# Std
+import os
+import math
+import argparse
+import tempfile
+from typing import Iterator
+# Local
+from helpers import get_mh_fragment_ids
+from services.db import DatabaseService
+from services.mh_client import LazyMediaHaven, load_config
+from services.ratelimit import RateLimiter
+
+# The client is only created (and its token requested) on first use
+mh_client = LazyMediaHaven()
+
+
+def fragment_ids_from_file(path: str) -> Iterator[str]:
+    """One fragment_id per line; blank lines are skipped."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fragment_id = line.strip()
+            if fragment_id:
+                yield fragment_id
+
+
+def search_to_file(query: str, or_id: str, page_size: int, rate: float, path: str) -> int:
+    """Page through the search results until `TotalNrOfResults` is reached,
+    writing them to `path` (one fragment_id per line). This is done before
+    loading them, so that no database transaction stays open while paging.
+    Returns the number of fragments found."""
+    rate_limiter = RateLimiter(rate)
+    found = pages = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while True:
+            page, total = rate_limiter.call(get_mh_fragment_ids, mh_client, query, or_id, found, page_size)
+            f.writelines(f"{fragment_id}\n" for fragment_id in page)
+            found += len(page)
+            pages += 1
+            if math.isnan(total):
+                # Without a total, a short page is the last one
+                total = found if len(page) < page_size else math.inf
+            if not page or found >= total:
+                print(f"Found {found} fragment(s) for: {query}")
+                return found
+            if pages % 100 == 0:
+                print(f"Found {found} fragment(s) so far...")
+
+
+def main():
+    svc_desc = """Python CLI interface to the `mh-mtd-updater`.
+    Loads fragments into the database-table, as PENDING, and then moves them
+    to TODO to be processed by `db-cli.py`."""
+    parser = argparse.ArgumentParser(description=svc_desc)
+    subparsers = parser.add_subparsers(dest="source", required=True)
+    file_parser = subparsers.add_parser("file", help="Load the fragment_ids in a file (one per line).")
+    file_parser.add_argument(
+        "input_file",
+        type=str,
+        help="Filepath to the file with one fragment_id per line.",
+    )
+    search_parser = subparsers.add_parser("search", help="Load the fragment_ids found by a MediaHaven search.")
+    search_parser.add_argument(
+        "-q",
+        "--query",
+        type=str,
+        required=True,
+        help="""MediaHaven query, eg. 'Dynamic.dc_title:"Some title"'. Always searched within the OR-id. (required)""",
+    )
+    search_parser.add_argument(
+        "--page-size",
+        type=int,
+        required=False,
+        default=100,
+        help="""Number of search results per request. (default: 100)""",
+    )
+    search_parser.add_argument(
+        "--rate",
+        type=float,
+        required=False,
+        default=None,
+        help="""Target number of requests per second to MediaHaven: backs off automatically when throttled. (default: unlimited)""",
+    )
+    for subparser in (file_parser, search_parser):
+        subparser.add_argument(
+            "-o",
+            "--or_id",
+            type=str,
+            required=True,
+            help="""The OR-id of the partner whom the fragments belong to (cp_id). (required)""",
+        )
+        subparser.add_argument(
+            "-t",
+            "--jira-ticket",
+            type=str,
+            required=True,
+            help="""Reference to differentiate this run: usually a reference to a Jira-ticket (jira_ticket). (required)""",
+        )
+        subparser.add_argument(
+            "--requeue",
+            type=bool,
+            action=argparse.BooleanOptionalAction,
+            default=False,
+            help="""Reset fragments that are already in the table to PENDING for this Jira-ticket (except when IN_PROGRESS), instead of leaving them alone.""",
+        )
+        subparser.add_argument(
+            "--promote",
+            type=bool,
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help="""Move the loaded fragments from PENDING to TODO. Use `--no-promote` to keep them PENDING, eg. for review.""",
+        )
+
+    args = parser.parse_args()
+    config = load_config()
+    db_conf = config["database"]
+    print(f"""Will connect to '{db_conf["table"]}' on '{db_conf["host"]}'.""")
+    database = DatabaseService(config, db_conf["table"], pool_size=1)
+
+    input_file = getattr(args, "input_file", None)
+    if args.source == "search":
+        fd, input_file = tempfile.mkstemp(prefix="mh_mtd_ingest_", suffix=".txt")
+        os.close(fd)
+        try:
+            search_to_file(args.query, args.or_id, args.page_size, args.rate, input_file)
+        except BaseException:
+            os.remove(input_file)
+            raise
+    try:
+        counts = database.bulk_load(
+            fragment_ids_from_file(input_file), args.or_id, args.jira_ticket, requeue=args.requeue, promote=args.promote
+        )
+    except BaseException:
+        if args.source == "search":
+            print(f"Could not load the search results: they are kept in {input_file} (load them with `ingest-cli.py file`).")
+        raise
+    if args.source == "search":
+        os.remove(input_file)
+    print(f"Loaded {counts['loaded']} fragment_id(s): {counts['inserted']} inserted{' or requeued' if args.requeue else ''}, {counts['promoted']} moved to TODO.")
+    if counts["skipped"]:
+        print(f"Skipped {counts['skipped']} blank fragment_id(s).")
+
+
+if __name__ == "__main__":
+    main()
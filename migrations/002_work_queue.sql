@@ -0,0 +1,145 @@
+-- Migration 002: claim-optimised indexes and cached status counts for the
+-- work-queue table `public.mh_mtd_cleanup` (on top of `schema.sql`).
+--
+-- Apply with (not in a single transaction: indexes are built CONCURRENTLY):
+--
+--     psql -v ON_ERROR_STOP=1 -f migrations/002_work_queue.sql
+--
+-- Checked against the queries in `services/db.py` (DatabaseService):
+--
+-- - `claim_items_to_process`: `WHERE status = 'TODO' [AND jira_ticket = ?]
+--   ORDER BY jira_ticket, created_at, fragment_id LIMIT ? FOR UPDATE SKIP
+--   LOCKED` is served, in order, by `mh_mtd_cleanup_todo_claim_idx`.
+-- - `release_stale_items`: `WHERE status = 'IN_PROGRESS' AND modified_at < ?`
+--   is served by `mh_mtd_cleanup_in_progress_idx`.
+-- - `release_items`, `update_db_status`, `update_with_results`: by the
+--   primary key.
+-- - `count_items_to_process`, `count_items_by_status`: compact and sum
+--   `mh_mtd_cleanup_status_counts` (a few delta rows per status) instead of
+--   counting the table.
+
+CREATE TABLE IF NOT EXISTS public.schema_migrations (
+	version int NOT NULL PRIMARY KEY,
+	description TEXT NOT NULL,
+	applied_at timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Partial indexes: only the rows that are queued or claimed are indexed, so
+-- they stay small however large the table (and its DONE-part) grows.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mh_mtd_cleanup_todo_claim_idx
+	ON public.mh_mtd_cleanup (jira_ticket, created_at, fragment_id) WHERE status = 'TODO';
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mh_mtd_cleanup_in_progress_idx
+	ON public.mh_mtd_cleanup (modified_at) WHERE status = 'IN_PROGRESS';
+-- Superseded by the partial indexes (and by the cached counts): every status
+-- change had to update it.
+DROP INDEX CONCURRENTLY IF EXISTS public.mh_mtd_cleanup_status_idx;
+
+BEGIN;
+
+-- Cached status counts, maintained by statement-level triggers (one
+-- aggregate per statement instead of a count(*) over the table). The triggers
+-- only append delta rows, so concurrent writers never wait on (or deadlock
+-- over) a shared counter row: the count of a status is the sum of its deltas,
+-- and `mh_mtd_cleanup_compact_status_counts()` folds them into one row per
+-- status.
+CREATE TABLE IF NOT EXISTS public.mh_mtd_cleanup_status_counts (
+	status TEXT NOT NULL,
+	count bigint NOT NULL
+);
+COMMENT ON TABLE public.mh_mtd_cleanup_status_counts IS 'Deltas of the number of records per status in mh_mtd_cleanup (sum per status), appended by triggers.';
+
+-- Transition tables are only available for the event they are declared for
+-- (eg. no `old_rows` on INSERT): hence one function per event.
+CREATE OR REPLACE FUNCTION mh_mtd_cleanup_count_inserts() RETURNS trigger AS $$
+BEGIN
+	INSERT INTO public.mh_mtd_cleanup_status_counts (status, count)
+	SELECT status, count(*) FROM new_rows GROUP BY status;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mh_mtd_cleanup_count_updates() RETURNS trigger AS $$
+BEGIN
+	INSERT INTO public.mh_mtd_cleanup_status_counts (status, count)
+	SELECT status, sum(delta) FROM (
+		SELECT status, 1 AS delta FROM new_rows
+		UNION ALL
+		SELECT status, -1 AS delta FROM old_rows
+	) AS changes
+	GROUP BY status
+	HAVING sum(delta) <> 0;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mh_mtd_cleanup_count_deletes() RETURNS trigger AS $$
+BEGIN
+	INSERT INTO public.mh_mtd_cleanup_status_counts (status, count)
+	SELECT status, -count(*) FROM old_rows GROUP BY status;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mh_mtd_cleanup_count_truncate() RETURNS trigger AS $$
+BEGIN
+	DELETE FROM public.mh_mtd_cleanup_status_counts;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Fold the deltas into one row per status. Deltas appended meanwhile are not
+-- touched. Only one compaction runs at a time: a concurrent call returns
+-- right away (the deltas are summed when read anyway).
+CREATE OR REPLACE FUNCTION mh_mtd_cleanup_compact_status_counts() RETURNS void AS $$
+BEGIN
+	IF NOT pg_try_advisory_xact_lock('public.mh_mtd_cleanup_status_counts'::regclass::oid::bigint) THEN
+		RETURN;
+	END IF;
+	WITH deleted AS (
+		DELETE FROM public.mh_mtd_cleanup_status_counts RETURNING status, count
+	)
+	INSERT INTO public.mh_mtd_cleanup_status_counts (status, count)
+	SELECT status, sum(count) FROM deleted GROUP BY status HAVING sum(count) <> 0;
+END;
+$$ LANGUAGE plpgsql;
+
+-- No writes while the counts are initialised (reads can go on)
+LOCK TABLE public.mh_mtd_cleanup IN SHARE MODE;
+
+DROP TRIGGER IF EXISTS count_inserts_mh_mtd_cleanup ON public.mh_mtd_cleanup;
+CREATE TRIGGER count_inserts_mh_mtd_cleanup AFTER INSERT ON public.mh_mtd_cleanup
+	REFERENCING NEW TABLE AS new_rows
+	FOR EACH STATEMENT EXECUTE FUNCTION mh_mtd_cleanup_count_inserts();
+DROP TRIGGER IF EXISTS count_updates_mh_mtd_cleanup ON public.mh_mtd_cleanup;
+CREATE TRIGGER count_updates_mh_mtd_cleanup AFTER UPDATE ON public.mh_mtd_cleanup
+	REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+	FOR EACH STATEMENT EXECUTE FUNCTION mh_mtd_cleanup_count_updates();
+DROP TRIGGER IF EXISTS count_deletes_mh_mtd_cleanup ON public.mh_mtd_cleanup;
+CREATE TRIGGER count_deletes_mh_mtd_cleanup AFTER DELETE ON public.mh_mtd_cleanup
+	REFERENCING OLD TABLE AS old_rows
+	FOR EACH STATEMENT EXECUTE FUNCTION mh_mtd_cleanup_count_deletes();
+DROP TRIGGER IF EXISTS count_truncate_mh_mtd_cleanup ON public.mh_mtd_cleanup;
+CREATE TRIGGER count_truncate_mh_mtd_cleanup AFTER TRUNCATE ON public.mh_mtd_cleanup
+	FOR EACH STATEMENT EXECUTE FUNCTION mh_mtd_cleanup_count_truncate();
+
+DELETE FROM public.mh_mtd_cleanup_status_counts;
+INSERT INTO public.mh_mtd_cleanup_status_counts (status, count)
+SELECT status, count(*) FROM public.mh_mtd_cleanup GROUP BY status;
+
+-- The row-level `sync_lastmod`-trigger ran a function for every updated row:
+-- `DatabaseService` sets `modified_at` in its UPDATE-statements itself, so the
+-- trigger now only fires for writers that do not (eg. fixes in psql), which
+-- `release_stale_items` still relies on.
+DROP TRIGGER IF EXISTS sync_lastmod_mh_mtd_cleanup ON public.mh_mtd_cleanup;
+CREATE TRIGGER sync_lastmod_mh_mtd_cleanup BEFORE UPDATE ON public.mh_mtd_cleanup
+	FOR EACH ROW WHEN (OLD.modified_at IS NOT DISTINCT FROM NEW.modified_at)
+	EXECUTE FUNCTION sync_lastmod_mh_mtd_cleanup();
+
+GRANT SELECT ON TABLE public.mh_mtd_cleanup_status_counts TO superset_readonly_user;
+ALTER TABLE public.mh_mtd_cleanup_status_counts OWNER TO mh_migration;
+
+INSERT INTO public.schema_migrations (version, description)
+VALUES (2, 'Claim-optimised indexes and cached status counts for mh_mtd_cleanup')
+ON CONFLICT (version) DO NOTHING;
+
+COMMIT;
@@ -0,0 +1,32 @@
+-- Migration 003: compact storage of the original metadata in
+-- `public.mh_mtd_cleanup` (see `db-cli.py --storage`).
+--
+-- Apply with:
+--
+--     psql -v ON_ERROR_STOP=1 -f migrations/003_compact_metadata.sql
+--
+-- Depending on the storage mode, a record's original metadata is kept in
+-- exactly one of:
+--
+-- - `original_metadata` (xml): the full or the reduced (Descriptive and
+--   Dynamic only) sidecar,
+-- - `original_metadata_zlib` (bytea): the zlib-compressed full sidecar,
+-- - `original_metadata_sha256`: only the SHA-256 of the full sidecar.
+
+BEGIN;
+
+ALTER TABLE public.mh_mtd_cleanup
+	ADD COLUMN IF NOT EXISTS original_metadata_zlib bytea NULL,
+	ADD COLUMN IF NOT EXISTS original_metadata_sha256 char(64) NULL;
+
+-- Already compressed: keep Postgres from trying again
+ALTER TABLE public.mh_mtd_cleanup ALTER COLUMN original_metadata_zlib SET STORAGE EXTERNAL;
+
+COMMENT ON COLUMN public.mh_mtd_cleanup.original_metadata_zlib IS 'Zlib-compressed metadata of the item in MediaHaven before transformation/update.';
+COMMENT ON COLUMN public.mh_mtd_cleanup.original_metadata_sha256 IS 'SHA-256 (hex) of the metadata of the item in MediaHaven before transformation/update.';
+
+INSERT INTO public.schema_migrations (version, description)
+VALUES (3, 'Compact storage of the original metadata in mh_mtd_cleanup')
+ON CONFLICT (version) DO NOTHING;
+
+COMMIT;
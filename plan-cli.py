@@ -0,0 +1,81 @@
+"""
+# plan-cli.py
+
+CLI interface to the `mh-mtd-updater` that applies an update plan, as written
+by a dry-run of `csv-cli.py`.
+"""
+
+# Std
+import argparse
+# 3d
+from lxml import etree
+# Libs
+from mediahaven.mediahaven import MediaHavenException, AcceptFormat
+# Local
+from helpers import error_from, error_msg_from
+from services import xpath
+from services.xvrl import reduceSidecar
+from services.mh_client import LazyMediaHaven
+from services.plan import PlanEntry, fingerprint, read_update_plan
+from services.ratelimit import RateLimiter
+
+# The client is only created (and its token requested) on first use
+mh_client = LazyMediaHaven()
+
+
+def apply_entry(entry: PlanEntry, rate_limiter: RateLimiter) -> str:
+    """Apply one planned update, but only if the record did not change since
+    the dry-run. Returns the outcome: `DONE`, `CHANGED`, `STALE` (nothing to
+    check against) or an error code."""
+    if not entry.ReducedSha256 and not entry.LastModifiedDate:
+        print(f"Skipping {entry.FragmentId}: the plan has no fingerprint to check the record against.")
+        return "STALE"
+    try:
+        mh_record_xml = rate_limiter.call(
+            mh_client.records.get, entry.FragmentId, accept_format=AcceptFormat.XML
+        )
+        rec = etree.fromstring(mh_record_xml.raw_response.encode("utf-8"))
+        if (
+            (entry.LastModifiedDate and xpath.last_modified(rec) != entry.LastModifiedDate)
+            or (entry.ReducedSha256 and fingerprint(reduceSidecar(rec)) != entry.ReducedSha256)
+        ):
+            print(f"Skipping {entry.FragmentId}: record changed since the dry-run.")
+            return "CHANGED"
+        rate_limiter.call(mh_client.records.update, entry.FragmentId, xml=entry.UpdateObject)
+    except MediaHavenException as e:
+        print(f"Status_code={e.status_code}, status_msg={error_from(e)}, msg={error_msg_from(e)}")
+        return error_from(e)
+    print(f"Succesfully updated {entry.IdentifierValue} => FragmentId:{entry.FragmentId}.")
+    return "DONE"
+
+
+def main():
+    svc_desc = """Python CLI interface to the `mh-mtd-updater`.
+    Applies the update plan written by a dry-run of `csv-cli.py`: exactly the
+    reviewed updates are performed, for records that did not change since."""
+    parser = argparse.ArgumentParser(description=svc_desc)
+    parser.add_argument(
+        "plan_file",
+        type=str,
+        help="Filepath to the update plan. (eg. ./reports/update_plan.jsonl)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        required=False,
+        default=None,
+        help="""Target number of requests per second to MediaHaven: backs off automatically when throttled. (default: unlimited)""",
+    )
+
+    args = parser.parse_args()
+    rate_limiter = RateLimiter(args.rate)
+
+    outcomes = {}
+    for entry in read_update_plan(args.plan_file):
+        outcome = apply_entry(entry, rate_limiter)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    print(f"Applied plan: {outcomes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 -- public.mh_mtd_cleanup definition
+-- (apply the migrations in ./migrations on top of it, in order)
 
 -- Drop table
 
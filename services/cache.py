@@ -0,0 +1,103 @@
+"""
+# cache.py
+
+Opt-in, persistent, local cache of MediaHaven search results (sidecars), so
+that repeated (dry-)runs over the same CSV do not need to fetch the same
+records again.
+Search results are keyed by OR-id, identifier field and value. Entries expire
+after a TTL and the oldest entries are evicted once the cache grows beyond its
+maximum size.
+"""
+
+# Std
+import json
+import time
+import sqlite3
+import threading
+from os import makedirs
+from os.path import join
+from typing import List, Optional
+# 3d
+from lxml import etree
+
+
+class SidecarCache:
+    """SQLite-backed cache of search results: the list of sidecars (as XML)
+    found for an identifier value within an OR-id. Thread-safe."""
+    def __init__(self, cache_dir: str, ttl: float = 24 * 3600, max_size: int = 512 * 1024**2):
+        makedirs(cache_dir, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(join(cache_dir, "sidecars.sqlite"), check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS search_results (
+                or_id TEXT NOT NULL,
+                field TEXT NOT NULL,
+                value TEXT NOT NULL,
+                sidecars TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (or_id, field, value)
+            );
+            CREATE INDEX IF NOT EXISTS search_results_fetched_at_idx ON search_results (fetched_at);
+        """)
+        self.size = self.db.execute("SELECT coalesce(sum(size), 0) FROM search_results").fetchone()[0]
+    #
+    def get(self, or_id: str, field: str, value: str) -> Optional[List[etree.Element]]:
+        """The cached sidecars for this value, or None when not cached (or
+        expired). An empty list means "cached as not found"."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT sidecars, fetched_at FROM search_results WHERE or_id = ? AND field = ? AND value = ?",
+                (or_id, field, value),
+            ).fetchone()
+        if not row or time.time() - row[1] > self.ttl:
+            return None
+        return [etree.fromstring(xml.encode("utf-8")) for xml in json.loads(row[0])]
+    #
+    def put(self, or_id: str, field: str, value: str, sidecars: List[etree.Element]):
+        data = json.dumps([etree.tostring(sidecar, encoding="unicode") for sidecar in sidecars])
+        with self.lock:
+            self._delete(or_id, field, value)
+            self.db.execute(
+                "INSERT INTO search_results VALUES (?, ?, ?, ?, ?, ?)",
+                (or_id, field, value, data, len(data), time.time()),
+            )
+            self.size += len(data)
+            self._evict()
+            self.db.commit()
+    #
+    def invalidate(self, or_id: str, field: str, value: str):
+        with self.lock:
+            self._delete(or_id, field, value)
+            self.db.commit()
+    #
+    def _delete(self, or_id: str, field: str, value: str):
+        key = (or_id, field, value)
+        row = self.db.execute(
+            "SELECT size FROM search_results WHERE or_id = ? AND field = ? AND value = ?", key
+        ).fetchone()
+        if row:
+            self.db.execute("DELETE FROM search_results WHERE or_id = ? AND field = ? AND value = ?", key)
+            self.size -= row[0]
+    #
+    def _evict(self):
+        """Drop expired entries and then the oldest ones until the cache fits
+        within its maximum size."""
+        if self.size <= self.max_size:
+            return
+        self.db.execute("DELETE FROM search_results WHERE fetched_at < ?", (time.time() - self.ttl,))
+        self.size = self.db.execute("SELECT coalesce(sum(size), 0) FROM search_results").fetchone()[0]
+        while self.size > self.max_size:
+            rows = self.db.execute(
+                "SELECT rowid, size FROM search_results ORDER BY fetched_at LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            self.db.executemany("DELETE FROM search_results WHERE rowid = ?", [(rowid,) for rowid, _ in rows])
+            self.size -= sum(size for _, size in rows)
+    #
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,78 @@
+"""
+# compare.py
+
+Semantic comparison of an MH-UpdateObject with the record it would update, to
+detect updates that would not change anything.
+"""
+
+# Std
+from typing import Optional
+# 3d
+from lxml import etree
+
+
+def canonical(el: etree.Element) -> tuple:
+    """Order-insensitive representation of an element's value: its localname,
+    stripped text and (sorted) children. Attributes are left out."""
+    return (
+        etree.QName(el).localname,
+        (el.text or "").strip(),
+        tuple(sorted(canonical(child) for child in el if isinstance(child.tag, str))),
+    )
+
+
+def merge_strategy(el: etree.Element) -> str:
+    for k, v in el.attrib.items():
+        if etree.QName(k).localname.lower() == "mergestrategy":
+            return v.upper()
+    return "OVERWRITE"
+
+
+def field_unchanged(update_field: etree.Element, original_field: Optional[etree.Element]) -> bool:
+    """Whether updating this field would leave the original as it is, taking
+    the field's merge strategy into account."""
+    strategy = merge_strategy(update_field)
+    if strategy == "KEEP":
+        return original_field is not None
+    if original_field is None:
+        return strategy == "SUBTRACT"
+    update_values = set(canonical(update_field)[2])
+    original_values = set(canonical(original_field)[2])
+    if not update_values:
+        # A single-valued field
+        update_values = {canonical(update_field)[:2]}
+        original_values = {canonical(original_field)[:2]}
+    if strategy == "MERGE":
+        return update_values <= original_values
+    if strategy == "SUBTRACT":
+        return not update_values & original_values
+    return canonical(update_field) == canonical(original_field)
+
+
+def is_noop_update(update_object: str | bytes, sidecar: etree.Element) -> bool:
+    """Whether all fields targeted by the update object already have the same
+    value in the sidecar.
+    Fields are the children of the update object's sections (eg. `Dynamic`,
+    `Descriptive`); leaf-elements directly under the root (eg. the reason for
+    the update) are not fields and are not compared."""
+    if isinstance(update_object, str):
+        update_object = update_object.encode("utf-8")
+    update = etree.fromstring(update_object)
+    sections = {etree.QName(s).localname: s for s in sidecar if isinstance(s.tag, str)}
+    for section in update:
+        if not isinstance(section.tag, str) or len(section) == 0:
+            continue
+        original_section = sections.get(etree.QName(section).localname)
+        for field in section:
+            if not isinstance(field.tag, str):
+                continue
+            original_field = None
+            if original_section is not None:
+                name = etree.QName(field).localname
+                original_field = next(
+                    (f for f in original_section if isinstance(f.tag, str) and etree.QName(f).localname == name),
+                    None,
+                )
+            if not field_unchanged(field, original_field):
+                return False
+    return True
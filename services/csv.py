@@ -1,9 +1,11 @@
 #
 
 # Std
+import io
 import csv
 from collections import Counter
-from typing import Dict
+from itertools import islice
+from typing import Dict, List, Optional
 
 from meemoo_mtd.mediahaven.fields import (
     fields as mh_known_fields,
@@ -14,25 +16,71 @@ class CsvInvalidError(Exception):
     pass
 
 
-# TODO: Read and parse the CSV-file only once!
+class _LineReader:
+    """Iterator over the decoded lines of a binary file that keeps track of the
+    byte offset it has read up to. The `csv`-module pulls lines one by one, so
+    the offset before each row is exactly where that row starts."""
+    def __init__(self, f, encoding: str):
+        self.f = f
+        self.encoding = encoding
+        self.offset = f.tell()
+    #
+    def __iter__(self):
+        return self
+    #
+    def __next__(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode(self.encoding)
+
+
 class CsvParser:
-    """Wrapper class around the CSV."""
-    def __init__(self, csv_filepath: str, delimiter: str = ','):
+    """Wrapper class around the CSV.
+    The file is read once, on init: the header, row lengths and identifier
+    values are collected in that same pass, together with the byte offset of
+    every row so that iteration can start at any row."""
+    def __init__(self, csv_filepath: str, delimiter: str = ',', encoding: str = 'utf-8'):
         self.csv_filepath = csv_filepath
         self.delimiter = delimiter
-        self.cols = self.get_header_cols()
+        self.encoding = encoding
+        self.offsets: List[int] = []
+        self.structure_error: Optional[str] = None
+        self.id_counts: Counter = Counter()
+        self.scan()
         self.id_col = self.cols[0]
         self.data_cols = self.cols[1:] if len(self.cols) > 1 else []
     #
+    def __len__(self):
+        """Number of rows, not counting the header."""
+        return len(self.offsets)
+    #
+    def scan(self):
+        """Single pass over the file: read the header, check the row lengths,
+        count the identifier values and record the offset of each row."""
+        with open(self.csv_filepath, 'rb') as csvfile:
+            lines = _LineReader(csvfile, self.encoding)
+            reader = csv.reader(lines, delimiter=self.delimiter)
+            self.cols = next(reader)
+            expected_columns = len(self.cols)
+            self.id_counts[self.cols[0]] += 1
+            offset = lines.offset
+            for row_num, row in enumerate(reader, 2):
+                if row:
+                    self.offsets.append(offset)
+                    self.id_counts[row[0]] += 1
+                if len(row) != expected_columns and not self.structure_error:
+                    self.structure_error = f"Error in row {row_num}: Column mismatch. Row: {row}"
+                offset = lines.offset
+    #
     def get_header_cols(self):
-        with open(self.csv_filepath) as csvfile:
-            reader = csv.reader(csvfile, delimiter=self.delimiter)
-            return next(reader)
+        return self.cols
     #
     def get_column_values(self, column: int = 1):
         assert not(column < 1), f"column needs to be a positive integer, starting from 1: {column}"
         val_list = []
-        with open(self.csv_filepath, newline='') as csvfile:
+        with open(self.csv_filepath, newline='', encoding=self.encoding) as csvfile:
             reader = csv.reader(csvfile, delimiter=self.delimiter)
             for row in reader:
                 val_list.append(row[column-1])
@@ -40,11 +88,10 @@ class CsvParser:
     #
     def get_duplicates_in_column(self, column: int = 1) -> Dict:
         """Detect and return duplicate values in a specific column in a CSV-file.
-        Defaults to the first column"""
+        Defaults to the first column, whose values are already counted on init."""
         # Get all values in the column
-        val_list = self.get_column_values(column)
+        counts = self.id_counts if column == 1 else Counter(self.get_column_values(column))
         # Count and return duplicates
-        counts = Counter(val_list)
         return {item: count for item, count in counts.items() if count > 1}
     #
     def check_identifier_field(self):
@@ -54,14 +101,9 @@ class CsvParser:
             raise CsvInvalidError(f"Following columnames are not recognized as MediaHaven identifier fieldnames: {self.id_col}")
     #
     def validate_structure(self):
-        # Validate row lengths
-        with open(self.csv_filepath, newline='') as csvfile:
-            reader = csv.reader(csvfile, delimiter=self.delimiter)
-            header = next(reader)
-            expected_columns = len(header)
-            for row_num, row in enumerate(reader, 2):
-                if len(row) != expected_columns:
-                    raise CsvInvalidError(f"Error in row {row_num}: Column mismatch. Row: {row}")
+        # Validate row lengths (checked on init)
+        if self.structure_error:
+            raise CsvInvalidError(self.structure_error)
     #
     def check_fieldnames(self):
         """Method to check a list or set of fieldnames for unknown or disallowed
@@ -87,9 +129,14 @@ class CsvParser:
         # Check for unicity of identifier values
         self.check_unique_identifiers()
     #
-    def iterator(self):
-        with open(self.csv_filepath, newline='') as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=self.delimiter)
-            for row in reader:
-                yield row
-
+    def iterator(self, start: int = 0, stop: Optional[int] = None):
+        """Iterate over the rows (as dicts), optionally starting from the
+        `start`th row (0-based, not counting the header) up to `stop`: seeks
+        directly to the row's offset."""
+        if start >= len(self.offsets):
+            return
+        with open(self.csv_filepath, 'rb') as binfile:
+            binfile.seek(self.offsets[start])
+            csvfile = io.TextIOWrapper(binfile, encoding=self.encoding, newline='')
+            reader = csv.DictReader(csvfile, fieldnames=self.cols, delimiter=self.delimiter)
+            yield from islice(reader, None if stop is None else stop - start)
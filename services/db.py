@@ -1,18 +1,25 @@
+import time
+import logging
+import threading
 from enum import Enum
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Iterable, List, Optional
 from psycopg_pool import ConnectionPool
 from psycopg.rows import class_row
 from psycopg.types.json import Jsonb
 
+log = logging.getLogger(__name__)
+
 
 class RecordStatus(str, Enum):
-    NEW = "NEW"
+    """As in the table's CHECK-constraint (see `schema.sql`)."""
+    PENDING = "PENDING"
     TODO = "TODO"
     IN_PROGRESS = "IN_PROGRESS"
     DONE = "DONE"
     ERROR = "ERROR"
+    ON_HOLD = "ON_HOLD"
 
 
 @dataclass
@@ -28,62 +35,315 @@ class MhCleanupRecord:
     error_msg: str
     created_at: datetime
     modified_at: datetime
+    # See `migrations/003_compact_metadata.sql`
+    original_metadata_zlib: Optional[bytes] = None
+    original_metadata_sha256: Optional[str] = None
 
 
 class DatabaseService(object):
-    def __init__(self, config: dict, table: str):
+    def __init__(self, config: dict, table: str, pool_size: int = 4):
         self.pool = ConnectionPool(
-            f"host={config['database']['host']} port={config['database']['port']} dbname={config['database']['dbname']} user={config['database']['user']} password={config['database']['password']}"
+            f"host={config['database']['host']} port={config['database']['port']} dbname={config['database']['dbname']} user={config['database']['user']} password={config['database']['password']}",
+            min_size=pool_size,
         )
         self.table = table
-
-    def count_items_to_process(self) -> int:
+        # Status counts maintained by triggers (see `migrations/002_work_queue.sql`),
+        # if the table has them
+        self.counts_table = f"{table}_status_counts"
         with self.pool.connection() as conn:
             with conn.cursor() as cur:
-                return cur.execute(
-                    f"SELECT count(*) FROM public.{self.table} WHERE status = 'TODO'"
+                if cur.execute("SELECT to_regclass(%s)", (f"public.{self.counts_table}",)).fetchone()[0] is None:
+                    self.counts_table = None
+                # Columns for compact storage of the original metadata
+                self.compact_columns = cur.execute(
+                    """SELECT count(*) = 2 FROM information_schema.columns
+                    WHERE table_schema = 'public' AND table_name = %s
+                    AND column_name IN ('original_metadata_zlib', 'original_metadata_sha256')""",
+                    (table,),
                 ).fetchone()[0]
 
-    # TODO: check Pyscopg docs to verify if both statements are executed within
-    # one and the same transaction!
+    def count_items_to_process(self, jira_ticket: Optional[str] = None) -> int:
+        return self.count_items_by_status(jira_ticket).get(RecordStatus.TODO.value, 0)
+
+    def bulk_load(
+        self,
+        fragment_ids: Iterable[str],
+        cp_id: str,
+        jira_ticket: str,
+        requeue: bool = False,
+        promote: bool = True,
+    ) -> Dict[str, int]:
+        """Stream fragment_ids into the table with COPY (via a temporary
+        staging table) and insert them as PENDING, all in one transaction.
+        Fragments that are already in the table are left alone, unless
+        `requeue`: then they are reset to PENDING for this `jira_ticket`
+        (except when IN_PROGRESS). With `promote`, the loaded rows are then
+        moved from PENDING to TODO. Blank fragment_ids are skipped.
+        Returns the number of loaded, skipped, inserted (or requeued) and
+        promoted rows."""
+        on_conflict = "DO NOTHING"
+        if requeue:
+            on_conflict = f"""DO UPDATE SET
+                cp_id = EXCLUDED.cp_id, jira_ticket = EXCLUDED.jira_ticket, status = EXCLUDED.status,
+                original_metadata = NULL, update_object = NULL, error = NULL, error_msg = NULL,
+                modified_at = CURRENT_TIMESTAMP
+            WHERE {self.table}.status <> '{RecordStatus.IN_PROGRESS.value}'"""
+        counts = {"loaded": 0, "skipped": 0, "inserted": 0, "promoted": 0}
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "CREATE TEMP TABLE mh_mtd_ingest (fragment_id varchar(96) NOT NULL) ON COMMIT DROP"
+                )
+                with cur.copy("COPY mh_mtd_ingest (fragment_id) FROM STDIN") as copy:
+                    for fragment_id in fragment_ids:
+                        fragment_id = (fragment_id or "").strip()
+                        if not fragment_id:
+                            counts["skipped"] += 1
+                            continue
+                        copy.write_row((fragment_id,))
+                        counts["loaded"] += 1
+                cur.execute(
+                    f"""INSERT INTO public.{self.table} (fragment_id, cp_id, jira_ticket, status)
+                    SELECT DISTINCT fragment_id, %s, %s, %s FROM mh_mtd_ingest
+                    ON CONFLICT (fragment_id) {on_conflict};""",
+                    (cp_id, jira_ticket, RecordStatus.PENDING.value),
+                )
+                counts["inserted"] = cur.rowcount
+                if promote:
+                    cur.execute(
+                        f"""UPDATE public.{self.table} AS t SET status = %s, modified_at = CURRENT_TIMESTAMP
+                        FROM (SELECT DISTINCT fragment_id FROM mh_mtd_ingest) AS s
+                        WHERE t.fragment_id = s.fragment_id AND t.status = %s AND t.jira_ticket = %s;""",
+                        (RecordStatus.TODO.value, RecordStatus.PENDING.value, jira_ticket),
+                    )
+                    counts["promoted"] = cur.rowcount
+                conn.commit()
+        return counts
+
+    def count_items_by_status(self, jira_ticket: Optional[str] = None) -> Dict[str, int]:
+        """Number of records per status (of the given `jira_ticket`, if any),
+        for all processes working on the table. Read from the cached counts,
+        when available and not filtering on a ticket, instead of counting the
+        whole table."""
+        if jira_ticket or not self.counts_table:
+            ticket_filter = "WHERE jira_ticket = %(jira_ticket)s" if jira_ticket else ""
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    return dict(cur.execute(
+                        f"SELECT status, count(*) FROM public.{self.table} {ticket_filter} GROUP BY status",
+                        {"jira_ticket": jira_ticket},
+                    ).fetchall())
+        self.compact_status_counts()
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                return dict(cur.execute(
+                    f"""SELECT status, sum(count)::bigint FROM public.{self.counts_table}
+                    GROUP BY status HAVING sum(count) > 0"""
+                ).fetchall())
+
+    def compact_status_counts(self):
+        """Fold the cached counts, deltas appended by triggers, into one row
+        per status, so that the counts table does not keep growing. A no-op
+        without the counts table, or while another process is compacting."""
+        if not self.counts_table:
+            return
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {self.table}_compact_status_counts()")
+                conn.commit()
+
+    @property
+    def cheap_counts(self) -> bool:
+        """Whether `count_items_by_status` reads the cached counts (without a
+        ticket filter) instead of counting the table."""
+        return self.counts_table is not None
+
+    def claim_items_to_process(self, batch_size: int = 1, jira_ticket: Optional[str] = None) -> List[MhCleanupRecord]:
+        """Atomically claim a batch of TODO-records by setting them IN_PROGRESS
+        and returning them, all in one statement.
+        Rows locked by another worker are skipped (`FOR UPDATE SKIP LOCKED`),
+        so multiple processes never claim the same fragment.
+        Records are claimed per ticket, oldest first (the order of the partial
+        claim-index), optionally only those of the given `jira_ticket`."""
+        ticket_filter = "AND jira_ticket = %(jira_ticket)s" if jira_ticket else ""
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(MhCleanupRecord)) as cur:
+                items = cur.execute(
+                    f"""UPDATE public.{self.table} SET status = %(claimed)s, modified_at = CURRENT_TIMESTAMP
+                    WHERE fragment_id IN (
+                        SELECT fragment_id FROM public.{self.table}
+                        WHERE status = %(todo)s {ticket_filter}
+                        ORDER BY jira_ticket, created_at, fragment_id
+                        LIMIT %(limit)s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING *;""",
+                    {
+                        "claimed": RecordStatus.IN_PROGRESS.value,
+                        "todo": RecordStatus.TODO.value,
+                        "jira_ticket": jira_ticket,
+                        "limit": batch_size,
+                    },
+                ).fetchall()
+                conn.commit()
+                return items
+
     def get_item_to_process(self) -> Optional[MhCleanupRecord]:
+        items = self.claim_items_to_process(1)
+        return items[0] if items else None
+
+    def get_item(self, fragment_id: str) -> Optional[MhCleanupRecord]:
         with self.pool.connection() as conn:
             with conn.cursor(row_factory=class_row(MhCleanupRecord)) as cur:
-                item = cur.execute(
-                    f"SELECT * FROM public.{self.table} WHERE status = 'TODO' LIMIT 1"
+                return cur.execute(
+                    f"SELECT * FROM public.{self.table} WHERE fragment_id = %s;", (fragment_id,)
                 ).fetchone()
-                if item:
-                    cur.execute(
-                        f"UPDATE public.{self.table} SET status = %s WHERE fragment_id = %s;",
-                        (RecordStatus.IN_PROGRESS.value, item.fragment_id),
-                    )
-                    conn.commit()
-                return item
+
+    def release_items(self, fragment_ids: List[str]):
+        """Hand claimed, but unprocessed, records back to the queue by setting
+        them from IN_PROGRESS back to TODO."""
+        if not fragment_ids:
+            return
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"UPDATE public.{self.table} SET status = %s, modified_at = CURRENT_TIMESTAMP WHERE fragment_id = ANY(%s) AND status = %s;",
+                    (RecordStatus.TODO.value, list(fragment_ids), RecordStatus.IN_PROGRESS.value),
+                )
+                conn.commit()
+
+    def release_stale_items(self, max_age_minutes: float) -> int:
+        """Hand records that have been IN_PROGRESS for longer than
+        `max_age_minutes` back to the queue, eg. after a worker crashed.
+        Returns the number of released records."""
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""UPDATE public.{self.table} SET status = %s, modified_at = CURRENT_TIMESTAMP
+                    WHERE status = %s AND modified_at < CURRENT_TIMESTAMP - %s * interval '1 minute';""",
+                    (RecordStatus.TODO.value, RecordStatus.IN_PROGRESS.value, max_age_minutes),
+                )
+                conn.commit()
+                return cur.rowcount
 
     def update_db_status(self, fragment_id: str, status: str):
         with self.pool.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    f"UPDATE public.{self.table} SET status = %s WHERE fragment_id = %s;",
+                    f"UPDATE public.{self.table} SET status = %s, modified_at = CURRENT_TIMESTAMP WHERE fragment_id = %s;",
                     (status, fragment_id),
                 )
                 conn.commit()
 
     def update_with_result(self, item: MhCleanupRecord):
         """Convenience method to update this record's state after a cleanup-run."""
+        self.update_with_results([item])
+
+    def update_with_results(self, items: List[MhCleanupRecord]):
+        """Update the state of multiple records after a cleanup-run, in one
+        transaction and one UPDATE-statement: the results are streamed with
+        COPY into a temporary table first, so that the statement-level
+        triggers (see `migrations/002_work_queue.sql`) fire once per batch."""
+        if not items:
+            return
+        columns = ["fragment_id", "original_metadata", "update_object", "status", "error", "error_msg"]
+        types = ["varchar(96)", "xml", "xml", "TEXT", "TEXT", "TEXT"]
+        if self.compact_columns:
+            columns += ["original_metadata_zlib", "original_metadata_sha256"]
+            types += ["bytea", "char(64)"]
         with self.pool.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    f"""UPDATE public.{self.table} SET
-                        original_metadata = %s, update_object = %s, status = %s, error = %s, error_msg = %s
-                    WHERE fragment_id = %s;""",
-                    (
-                        item.original_metadata,
-                        item.update_object,
-                        item.status,
-                        item.error,
-                        item.error_msg,
-                        item.fragment_id,
-                    ),
+                    f"""CREATE TEMP TABLE mh_mtd_results ({", ".join(f"{column} {type_}" for column, type_ in zip(columns, types))})
+                    ON COMMIT DROP"""
+                )
+                with cur.copy(f"COPY mh_mtd_results ({', '.join(columns)}) FROM STDIN") as copy:
+                    for item in items:
+                        copy.write_row([getattr(item, column) for column in columns])
+                cur.execute(
+                    f"""UPDATE public.{self.table} AS t SET
+                        {", ".join(f"{column} = r.{column}" for column in columns[1:])},
+                        modified_at = CURRENT_TIMESTAMP
+                    FROM mh_mtd_results AS r
+                    WHERE t.fragment_id = r.fragment_id;"""
                 )
                 conn.commit()
+
+
+class ResultWriter(object):
+    """Buffer finished records and write them back to the database in bulk,
+    once `max_size` records are buffered or, at the latest, every `max_age`
+    seconds (from a background thread, so that slow runs do not hold on to
+    their results). Thread-safe; use as a context manager so that the buffer
+    is flushed on shutdown.
+    When a bulk write fails, the records are written one by one; records that
+    can still not be written are put back in the buffer for the next flush.
+    The background thread also compacts the status counts, whatever the run's
+    ticket filter or progress reporting."""
+    def __init__(self, database: DatabaseService, max_size: int = 50, max_age: float = 5.0):
+        self.database = database
+        self.max_size = max_size
+        self.max_age = max_age
+        self.buffer: List[MhCleanupRecord] = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self._stop.set()
+        self._thread.join()
+        failed = self.flush()
+        if failed and exc_type is None:
+            raise RuntimeError(f"Could not write {failed} result(s) to the database: they stay IN_PROGRESS.")
+
+    def _run(self):
+        while not self._stop.wait(self.max_age):
+            self.flush()
+            try:
+                self.database.compact_status_counts()
+            except Exception as e:
+                # Compacting is only housekeeping: it should never stop a run
+                log.warning("Could not compact the status counts: %s", e)
+
+    def add(self, item: MhCleanupRecord):
+        with self.lock:
+            self.buffer.append(item)
+            if (
+                len(self.buffer) < self.max_size
+                and time.monotonic() - self.last_flush < self.max_age
+            ):
+                return
+            items, self.buffer = self.buffer, []
+            self.last_flush = time.monotonic()
+        self._write(items)
+
+    def flush(self) -> int:
+        """Write the buffer. Returns the number of records that could not be
+        written (and are back in the buffer)."""
+        with self.lock:
+            items, self.buffer = self.buffer, []
+            self.last_flush = time.monotonic()
+        return self._write(items)
+
+    def _write(self, items: List[MhCleanupRecord]) -> int:
+        try:
+            self.database.update_with_results(items)
+            return 0
+        except Exception as e:
+            log.warning("Could not write %s result(s) at once, writing them one by one: %s", len(items), e)
+        failed = []
+        for item in items:
+            try:
+                self.database.update_with_result(item)
+            except Exception as e:
+                log.error('Could not write the result of "%s": %s', item.fragment_id, e)
+                failed.append(item)
+        if failed:
+            with self.lock:
+                self.buffer[:0] = failed
+        return len(failed)
@@ -0,0 +1,86 @@
+"""
+# journal.py
+
+Append-only checkpoint journal for CSV-runs, so that an interrupted run can be
+resumed instead of started over.
+One JSON-object per line (JSONL):
+
+- a `run`-line with the run's parameters, once per (resumed) run,
+- a `record`-line as soon as a MediaHaven-record has been updated,
+- a `row`-line as soon as a CSV-row is finished (these are written in CSV
+  order), with its status: rows that did not finish as DONE are handled
+  again when resuming.
+"""
+
+# Std
+import json
+import threading
+from os.path import exists
+from typing import Dict, List, Optional, Set
+
+
+class Journal:
+    """Thread-safe JSONL-journal. Every line is flushed as it is written."""
+    def __init__(self, path: str, run: dict, resume: bool = False):
+        self.path = path
+        self.run = run
+        self.resume = resume
+        # State of a previous run, when resuming
+        self.last_row: Optional[int] = None
+        # The last status of every finished row
+        self.row_status: Dict[int, str] = {}
+        self.done_records: Set[str] = set()
+        self.lock = threading.Lock()
+        self._f = None
+    #
+    def __enter__(self):
+        if self.resume and exists(self.path):
+            self.load()
+        self._f = open(self.path, "a" if self.resume else "w", encoding="utf-8")
+        self._write({"type": "run", **self.run})
+        return self
+    #
+    def __exit__(self, *exc):
+        self._f.close()
+    #
+    def load(self):
+        """Read the state of the previous run(s). The run-parameters have to
+        match: eg. a dry-run can not be resumed as a real run."""
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry["type"] == "run":
+                    previous = {k: v for k, v in entry.items() if k != "type"}
+                    if previous != self.run:
+                        raise ValueError(f"Can not resume: journal {self.path} is of another run: {previous}")
+                elif entry["type"] == "row":
+                    self.last_row = max(entry["row"], self.last_row or 0)
+                    self.row_status[entry["row"]] = entry["status"]
+                elif entry["type"] == "record" and entry["status"] == "DONE":
+                    self.done_records.add(entry["FragmentId"])
+    #
+    @property
+    def next_row(self) -> int:
+        """Index of the first row (0-based, not counting the header) that has
+        not been finished yet."""
+        return 0 if self.last_row is None else self.last_row + 1
+    #
+    @property
+    def failed_rows(self) -> List[int]:
+        """Indexes of the rows before `next_row` that did not finish as DONE
+        (eg. because MediaHaven was unavailable), to be handled again."""
+        return sorted(row for row, status in self.row_status.items() if status != "DONE")
+    #
+    def record_done(self, row: int, fragment_id: str):
+        self._write({"type": "record", "row": row, "FragmentId": fragment_id, "status": "DONE"})
+    #
+    def row_done(self, row: int, identifier_value: str, status: str):
+        self._write({"type": "row", "row": row, "IdentifierValue": identifier_value, "status": status})
+    #
+    def _write(self, entry: dict):
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            self._f.write(line)
+            self._f.flush()
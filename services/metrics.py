@@ -0,0 +1,162 @@
+"""
+# metrics.py
+
+Per-stage timing metrics for long-running updates: latency histograms per
+stage, counters per outcome and error code, and a records-per-second gauge.
+Exposed in the Prometheus text format, over a small local HTTP endpoint and/or
+as a periodically (re)written file, and summarized in a table at exit.
+"""
+
+# Std
+import os
+import time
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "mh_mtd_updater"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as in Prometheus."""
+    __slots__ = ("counts", "sum", "count", "max")
+    #
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+    #
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    """Thread-safe registry of the run's metrics."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.stages = defaultdict(Histogram)
+        self.records = defaultdict(int)
+        self.errors = defaultdict(int)
+        # Called with (stage, start, seconds) for every observation, eg. by
+        # the profiler to trace the stages as spans
+        self.listeners = []
+    #
+    @contextmanager
+    def stage(self, name: str):
+        """Time the enclosed block as one observation of the given stage."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            self.observe(name, seconds)
+            for listener in self.listeners:
+                listener(name, start, seconds)
+    #
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            self.stages[name].observe(seconds)
+    #
+    def record_done(self, status: str, error: str | None = None):
+        """Count a finished record by its status and, if any, its error code
+        (as returned by `error_from`)."""
+        with self.lock:
+            self.records[status] += 1
+            if error:
+                self.errors[error] += 1
+    #
+    @property
+    def records_done(self) -> int:
+        """Number of records finished by this run."""
+        with self.lock:
+            return sum(self.records.values())
+    #
+    @property
+    def records_per_second(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return sum(self.records.values()) / elapsed if elapsed else 0.0
+    #
+    def to_prometheus(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = [
+            f"# HELP {PREFIX}_stage_seconds Duration of each stage of handling a record.",
+            f"# TYPE {PREFIX}_stage_seconds histogram",
+        ]
+        with self.lock:
+            for name, h in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{name}"}} {h.sum}')
+                lines.append(f'{PREFIX}_stage_seconds_count{{stage="{name}"}} {h.count}')
+            lines.append(f"# HELP {PREFIX}_records_total Finished records by status.")
+            lines.append(f"# TYPE {PREFIX}_records_total counter")
+            for status, count in sorted(self.records.items()):
+                lines.append(f'{PREFIX}_records_total{{status="{status}"}} {count}')
+            lines.append(f"# HELP {PREFIX}_errors_total Errors by error code.")
+            lines.append(f"# TYPE {PREFIX}_errors_total counter")
+            for error, count in sorted(self.errors.items()):
+                lines.append(f'{PREFIX}_errors_total{{error="{error}"}} {count}')
+        lines.append(f"# HELP {PREFIX}_records_per_second Average throughput since the start of the run.")
+        lines.append(f"# TYPE {PREFIX}_records_per_second gauge")
+        lines.append(f"{PREFIX}_records_per_second {self.records_per_second}")
+        return "\n".join(lines) + "\n"
+    #
+    def summary(self) -> str:
+        """Human readable table of the stages and outcomes."""
+        rows = [f"{'Stage':<16} {'Count':>8} {'Total (s)':>10} {'Mean (ms)':>10} {'Max (ms)':>10}"]
+        with self.lock:
+            for name, h in sorted(self.stages.items()):
+                mean = h.sum / h.count if h.count else 0.0
+                rows.append(f"{name:<16} {h.count:>8} {h.sum:>10.1f} {mean * 1000:>10.1f} {h.max * 1000:>10.1f}")
+            rows.append(f"Records: {dict(self.records)}")
+            rows.append(f"Errors: {dict(self.errors)}")
+        rows.append(f"Throughput: {self.records_per_second:.2f} records/s")
+        return "\n".join(rows)
+    #
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Expose the metrics on http://host:port/metrics (in a daemon thread)."""
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    #
+    def write_periodically(self, path: str, interval: float = 15.0):
+        """(Re)write the metrics to a file every `interval` seconds (in a
+        daemon thread), eg. for node_exporter's textfile collector."""
+        def loop():
+            while True:
+                self.write(path)
+                time.sleep(interval)
+        threading.Thread(target=loop, daemon=True).start()
+    #
+    def write(self, path: str):
+        # Write-then-rename, so that readers never see a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+# One registry per process
+metrics = Metrics()
@@ -0,0 +1,137 @@
+"""
+# mh_client.py
+
+Lazily created configuration and MediaHaven-client.
+
+Nothing is read or requested until a run actually needs it: `-h` or a
+validation does not hit the network. The OAuth-token is renewed proactively
+before it expires (going by the `expires_in` of the token response), and on
+a 401 the token is renewed before the error is raised, so that the caller's
+`RateLimiter` retries the request once with the new token: multi-hour runs do
+not fail on an expired token.
+"""
+
+# Std
+import time
+import math
+import logging
+import threading
+from functools import lru_cache
+from typing import Optional
+# Libs
+from viaa.configuration import ConfigParser
+#
+from mediahaven import MediaHaven
+from mediahaven.mediahaven import MediaHavenException
+from mediahaven.oauth2 import ROPCGrant
+
+log = logging.getLogger(__name__)
+
+# Lifetime of a MediaHaven token (in seconds) when the token response does
+# not tell, unless configured otherwise with `mediahaven.token_lifetime`
+TOKEN_LIFETIME = 3600
+# Renew the token this many seconds before it expires
+REFRESH_MARGIN = 300
+
+
+@lru_cache(maxsize=None)
+def load_config() -> dict:
+    """The app-config, read on first use."""
+    return ConfigParser().app_cfg
+
+
+def token_expires_in(grant: ROPCGrant) -> Optional[float]:
+    """Number of seconds until the grant's token expires, from the token
+    response as kept by its OAuth2-session (`expires_at`, or else
+    `expires_in`), or None when it does not tell."""
+    token = getattr(getattr(grant, "session", None), "token", None) or {}
+    for key, remaining in (
+        ("expires_at", lambda v: v - time.time()),
+        ("expires_in", lambda v: v),
+    ):
+        try:
+            value = float(token[key])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if math.isfinite(value):
+            return remaining(value)
+    return None
+
+
+class LazyMediaHaven:
+    """Stand-in for a `MediaHaven`-client: eg. `mh_client.records.get(...)` is
+    looked up on the current client at call time. The client is created, and
+    its token requested, on first use. Thread-safe."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._client: Optional[MediaHaven] = None
+        self._expires = 0.0
+    #
+    def __getattr__(self, name: str) -> "_ClientCall":
+        if name.startswith("_") and name != "_get":
+            raise AttributeError(name)
+        return _ClientCall(self, (name,))
+    #
+    @property
+    def client(self) -> MediaHaven:
+        with self.lock:
+            if self._client is None or time.monotonic() >= self._expires:
+                self._login()
+            return self._client
+    #
+    def renew(self, stale: MediaHaven):
+        """Request a new token, unless another thread already did so since
+        `stale` was handed out."""
+        with self.lock:
+            if self._client is stale:
+                self._login()
+    #
+    def _login(self):
+        mh_config = load_config()["mediahaven"]
+        if self._client is not None:
+            log.info("Renewing MediaHaven token.")
+        grant = ROPCGrant(
+            mh_config["host"],
+            mh_config["client_id"],
+            mh_config["client_secret"],
+        )
+        grant.request_token(mh_config["username"], mh_config["password"])
+        self._client = MediaHaven(mh_config["host"], grant)
+        lifetime = token_expires_in(grant)
+        if lifetime is None:
+            lifetime = float(mh_config.get("token_lifetime") or TOKEN_LIFETIME)
+        self._expires = time.monotonic() + max(lifetime - REFRESH_MARGIN, lifetime / 2)
+    #
+    def call(self, path: tuple, *args, **kwargs):
+        """Call the attribute-path on the current client. On a 401, the token
+        is renewed and the error re-raised: the request is retried (once) by
+        the `RateLimiter` it was sent through, within the rate limit."""
+        client = self.client
+        try:
+            return _resolve(client, path)(*args, **kwargs)
+        except MediaHavenException as e:
+            if e.status_code == 401:
+                log.warning("Unauthorized on %s: renewing the token.", ".".join(path))
+                self.renew(client)
+            raise
+
+
+class _ClientCall:
+    """An attribute-path on the client, eg. `records.get`, called lazily."""
+    def __init__(self, factory: LazyMediaHaven, path: tuple):
+        self.factory = factory
+        self.path = path
+    #
+    def __getattr__(self, name: str) -> "_ClientCall":
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _ClientCall(self.factory, self.path + (name,))
+    #
+    def __call__(self, *args, **kwargs):
+        return self.factory.call(self.path, *args, **kwargs)
+
+
+def _resolve(obj, path: tuple):
+    for name in path:
+        obj = getattr(obj, name)
+    return obj
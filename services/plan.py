@@ -0,0 +1,63 @@
+"""
+# plan.py
+
+Compact update plan, written by a dry-run of `csv-cli.py` and executed by
+`plan-cli.py`: exactly the updates that were reviewed get applied, without
+searching and transforming all over again.
+One JSON-object per line (JSONL), one line per MediaHaven-record.
+"""
+
+# Std
+import json
+import hashlib
+from typing import Iterator, NamedTuple
+# 3d
+from lxml import etree
+
+
+class PlanEntry(NamedTuple):
+    FragmentId: str
+    IdentifierValue: str
+    # Fingerprints of the original record: MediaHaven's last-modified date is
+    # cheap to compare and changes with every update of the record; the hash
+    # of the reduced sidecar (see `fingerprint`) also covers records without
+    # one. Empty when unknown (eg. in plans written before it was added).
+    LastModifiedDate: str
+    UpdateObject: str
+    ReducedSha256: str = ""
+
+
+def fingerprint(reduced_sidecar: str) -> str:
+    """SHA-256 of a reduced sidecar (see `xvrl.reduceSidecar`), canonicalized
+    (exclusive C14N, without blank text) so that it does not depend on how the
+    record was fetched (by a search or by its FragmentId) or serialized."""
+    parser = etree.XMLParser(remove_blank_text=True)
+    root = etree.fromstring(reduced_sidecar.encode("utf-8"), parser)
+    return hashlib.sha256(etree.tostring(root, method="c14n", exclusive=True)).hexdigest()
+
+
+class UpdatePlanWriter:
+    """Write plan entries to a JSONL-file, flushing every entry.
+    When resuming a run, entries are appended to the existing plan."""
+    def __init__(self, path: str, append: bool = False):
+        self.path = path
+        self.append = append
+        self._f = None
+    #
+    def __enter__(self):
+        self._f = open(self.path, "a" if self.append else "w", encoding="utf-8")
+        return self
+    #
+    def __exit__(self, *exc):
+        self._f.close()
+    #
+    def write(self, entry: PlanEntry):
+        self._f.write(json.dumps(entry._asdict(), ensure_ascii=False) + "\n")
+        self._f.flush()
+
+
+def read_update_plan(path: str) -> Iterator[PlanEntry]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield PlanEntry(**json.loads(line))
@@ -0,0 +1,119 @@
+"""
+# profiling.py
+
+Opt-in profiling of a run, for finding out where the time goes (eg. in
+`transform()`, Saxon or lxml) after an upgrade of a dependency. Only every Nth
+record is sampled, to keep the overhead low on production runs. Writes:
+
+- `<path>.pstats`: cProfile stats of the sampled records (view with eg.
+  `python -m pstats` or snakeviz),
+- `<path>.trace.json`: a span per sampled record and per stage of handling it,
+  in the Chrome trace event format (load in speedscope, Perfetto or
+  chrome://tracing).
+"""
+
+# Std
+import os
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+# Local
+from services.metrics import metrics
+
+
+class Profiler:
+    """Samples every Nth record: its stages (as timed by `metrics`) are traced
+    as spans, and its handling is profiled with cProfile. Does nothing until
+    started."""
+    def __init__(self):
+        self.path = None
+        self.every = 1
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.count = 0
+        self.events = []
+        self.profile = cProfile.Profile()
+        # cProfile can only profile one record at a time
+        self.profile_lock = threading.Lock()
+        self.started = time.monotonic()
+    #
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+    #
+    def start(self, path: str, every: int = 1):
+        self.path = path
+        self.every = max(1, every)
+        self.started = time.monotonic()
+        metrics.listeners.append(self.stage_done)
+    #
+    def stop(self):
+        """Write the cProfile stats and the trace."""
+        if not self.enabled:
+            return
+        metrics.listeners.remove(self.stage_done)
+        self.profile.dump_stats(f"{self.path}.pstats")
+        with self.lock:
+            trace = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+        with open(f"{self.path}.trace.json", "w", encoding="utf-8") as f:
+            json.dump(trace, f)
+        print(f"Profile written to: {self.path}.pstats and {self.path}.trace.json")
+        self.path = None
+    #
+    def sampled(self) -> bool:
+        """Whether the current thread is handling a sampled record."""
+        return getattr(self.local, "record", None) is not None
+    #
+    @contextmanager
+    def record(self, key: str):
+        """Handle one record, sampling it if it is the Nth."""
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            sample = self.count % self.every == 0
+            self.count += 1
+        if not sample:
+            yield
+            return
+        profiling = self.profile_lock.acquire(blocking=False)
+        self.local.record = key
+        start = time.monotonic()
+        if profiling:
+            self.profile.enable()
+        try:
+            yield
+        finally:
+            if profiling:
+                self.profile.disable()
+                self.profile_lock.release()
+            self.local.record = None
+            self.span("record", start, time.monotonic() - start, {"record": key})
+    #
+    def call(self, key: str, fn, *args, **kwargs):
+        """Call `fn` as the handling of record `key`."""
+        with self.record(key):
+            return fn(*args, **kwargs)
+    #
+    def stage_done(self, name: str, start: float, seconds: float):
+        if self.sampled():
+            self.span(name, start, seconds, {"record": self.local.record})
+    #
+    def span(self, name: str, start: float, seconds: float, args: dict):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.started) * 1e6,
+            "dur": seconds * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+
+# One profiler per process
+profiler = Profiler()
@@ -0,0 +1,115 @@
+"""
+# progress.py
+
+Periodic progress reporting for database-driven runs. The counts come from the
+database's status aggregates, so they include the work of every process on the
+table, and the ETA is based on the measured throughput, smoothed with an
+exponentially weighted moving average (EWMA).
+When the counts have to be computed from the table itself (no cached counts,
+or only a single ticket), they are polled at most every `EXPENSIVE_INTERVAL`
+seconds.
+"""
+
+# Std
+import time
+import logging
+import datetime
+import threading
+from typing import Callable, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+# Minimal number of seconds between polls that count the whole table
+EXPENSIVE_INTERVAL = 300.0
+
+
+def format_eta(remaining: int, throughput: Optional[float]) -> str:
+    if not remaining:
+        return "0:00:00"
+    if not throughput:
+        return "unknown (no throughput measured yet)"
+    secs = round(remaining / throughput)
+    finish = datetime.datetime.now() + datetime.timedelta(seconds=secs)
+    return f"{datetime.timedelta(seconds=secs)} (around {finish:%Y-%m-%d %H:%M})"
+
+
+class ProgressReporter:
+    """Poll the status counts every `interval` seconds (in a daemon thread)
+    and print them with the throughput and ETA. Use as a context manager.
+    The counts are those of the run's `jira_ticket`, if any, and the remaining
+    items are capped by the run's `limit`, minus the number of items this run
+    already `processed()`."""
+    def __init__(
+        self,
+        database,
+        interval: float = 30.0,
+        alpha: float = 0.3,
+        limit: Optional[int] = None,
+        jira_ticket: Optional[str] = None,
+        processed: Optional[Callable[[], int]] = None,
+    ):
+        self.database = database
+        self.interval = interval
+        self.alpha = alpha
+        self.limit = limit
+        self.jira_ticket = jira_ticket
+        self.processed = processed or (lambda: 0)
+        if (jira_ticket or not database.cheap_counts) and interval < EXPENSIVE_INTERVAL:
+            log.warning(
+                "Counting the statuses on the table itself: reporting progress every %s seconds instead of %s.",
+                EXPENSIVE_INTERVAL, interval,
+            )
+            self.interval = EXPENSIVE_INTERVAL
+        self.throughput: Optional[float] = None
+        self._last: Optional[tuple] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    #
+    def __enter__(self):
+        self.poll()
+        self._thread.start()
+        return self
+    #
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.report()
+    #
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                # Progress reporting should never stop a run
+                log.warning("Could not report progress: %s", e)
+    #
+    def poll(self) -> Dict[str, int]:
+        """Fetch the status counts and update the smoothed throughput."""
+        counts = self.database.count_items_by_status(self.jira_ticket)
+        now = time.monotonic()
+        finished = counts.get("DONE", 0) + counts.get("ERROR", 0)
+        if self._last is not None:
+            last_time, last_finished = self._last
+            if now - last_time < 1.0:
+                # Too short to measure (eg. the final report)
+                return counts
+            sample = max(finished - last_finished, 0) / (now - last_time)
+            if self.throughput is None:
+                self.throughput = sample
+            else:
+                self.throughput = self.alpha * sample + (1 - self.alpha) * self.throughput
+        self._last = (now, finished)
+        return counts
+    #
+    def report(self):
+        counts = self.poll()
+        remaining = counts.get("TODO", 0) + counts.get("IN_PROGRESS", 0)
+        if self.limit:
+            remaining = min(remaining, max(self.limit - self.processed(), 0))
+        throughput = f"{self.throughput:.2f}" if self.throughput is not None else "?"
+        print(
+            f"Progress: done={counts.get('DONE', 0)} error={counts.get('ERROR', 0)} "
+            f"in_progress={counts.get('IN_PROGRESS', 0)} todo={counts.get('TODO', 0)} "
+            f"remaining={remaining} | "
+            f"{throughput} items/s | ETA: {format_eta(remaining, self.throughput)}"
+        )
@@ -0,0 +1,120 @@
+"""
+# ratelimit.py
+
+Adaptive rate limiter for calls to MediaHaven.
+
+A token bucket that targets a configurable request rate. The rate is halved
+whenever MediaHaven answers with one of the (retried) throttling status codes
+and ramps back up to the target as long as responses are healthy. Without a
+target rate, requests are not limited until MediaHaven throttles: then all
+callers pause, twice as long on every consecutive throttled response.
+"""
+
+# Std
+import time
+import logging
+import threading
+from typing import Any, Callable, Optional
+# Libs
+from mediahaven.mediahaven import MediaHavenException
+
+log = logging.getLogger(__name__)
+
+# Status codes on which MediaHaven tells us to slow down: the request is
+# retried (after backing off)
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+
+def is_throttled(status_code: Optional[int]) -> bool:
+    """Whether MediaHaven's response tells us to slow down."""
+    return status_code in RETRY_STATUS_CODES
+
+
+class RateLimiter:
+    """Thread-safe token bucket with additive-increase/multiplicative-decrease
+    of its rate (in requests per second). A `target_rate` of None means
+    unlimited."""
+    def __init__(self,
+            target_rate: Optional[float] = None,
+            min_rate: float = 0.1,
+            burst: float = 1.0,
+            max_retries: int = 5,
+            min_pause: float = 0.5,
+            max_pause: float = 30.0):
+        self.target_rate = target_rate
+        self.min_rate = min(min_rate, target_rate) if target_rate else min_rate
+        self.rate = target_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.min_pause = min_pause
+        self.max_pause = max_pause
+        self.pause = 0.0
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+    #
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate is None:
+                    if now >= self.blocked_until:
+                        return
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+    #
+    def throttled(self):
+        """Back off: halve the rate or, when unlimited, pause all callers."""
+        with self.lock:
+            if self.rate is not None:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = 0
+            else:
+                self.pause = min(self.max_pause, self.pause * 2) if self.pause else self.min_pause
+                self.blocked_until = max(self.blocked_until, time.monotonic() + self.pause)
+        log.warning("Throttled by MediaHaven: rate=%s req/s, pause=%.1fs", self.rate, self.pause)
+    #
+    def healthy(self):
+        """Ramp back up towards the target rate."""
+        with self.lock:
+            if self.rate is None:
+                self.pause = 0.0
+            elif self.rate < self.target_rate:
+                self.rate = min(self.target_rate, self.rate + self.target_rate / 100)
+    #
+    def call(self, fn: Callable, *args, **kwargs) -> Any:
+        """Call `fn` (a request to MediaHaven) within the rate limit.
+        The call is retried when MediaHaven returns one of `RETRY_STATUS_CODES`;
+        after `max_retries` the `MediaHavenException` is re-raised. A 401 is
+        retried once: the (lazy) client renews its token before raising it
+        (see `services.mh_client`)."""
+        retries = 0
+        reauthorized = False
+        while True:
+            self.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except MediaHavenException as e:
+                if e.status_code == 401 and not reauthorized:
+                    reauthorized = True
+                    log.info("Retrying with a new token after status_code=401")
+                    continue
+                if not is_throttled(e.status_code):
+                    raise
+                self.throttled()
+                if retries == self.max_retries:
+                    raise
+                retries += 1
+                log.info("Retrying after status_code=%s (attempt %s)", e.status_code, retries)
+            else:
+                self.healthy()
+                return result
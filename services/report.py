@@ -0,0 +1,197 @@
+"""
+# report.py
+
+Sharded rendering of the HTML-report: instead of one XSLT-transform over the
+whole XVRL-document, the reports are rendered in chunks (each a page with its
+records and their detail pages) on a pool of worker processes, plus an index
+page linking to the chunks.
+
+Every worker process compiles the stylesheet once and reuses it for all the
+chunks it renders. Chunks can be rendered after the run (`render_xvrl`), or
+while the run is still going (by `add`-ing the reports as they are written).
+"""
+
+# Std
+import os
+import copy
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from os.path import abspath, dirname, join
+from typing import List, Optional
+# 3d
+from lxml import etree
+# Local
+from services import xvrl
+from services.xvrl import NS_MAP
+
+REPORT_TAG = f"{{{NS_MAP['xvrl']}}}report"
+METADATA_TAG = f"{{{NS_MAP['xvrl']}}}metadata"
+DIGEST_TAG = f"{{{NS_MAP['xvrl']}}}digest"
+CHUNK_TAG = f"{{{NS_MAP['mm']}}}Chunk"
+
+
+def is_valid(report: etree._Element) -> bool:
+    digest = report.find(DIGEST_TAG)
+    return digest is not None and digest.get("valid") == "true"
+
+
+def render_chunk(path_to_xslt: str, path_to_xml: str, path_to_output: str, params: dict) -> str:
+    """Render one chunk: runs in a worker process, with its own (cached)
+    compiled stylesheet."""
+    return xvrl.transformer.transform_to_file(path_to_xslt, path_to_xml, path_to_output, params)
+
+
+class ShardedReportRenderer:
+    """Render the reports, as they are added, in chunks of `chunk_size` on
+    `workers` processes. On close, the index page (`path_to_output_html`) is
+    written once all chunks are rendered. With `incremental`, the index is
+    also (re)written whenever a chunk is handed off, listing the chunks that
+    are rendered so far, so that the report can be opened during the run.
+    Use as a context manager."""
+    def __init__(
+        self,
+        path_to_output_html: str,
+        chunk_size: int = 1000,
+        workers: int = 1,
+        incremental: bool = False,
+        path_to_xslt: str = "./xslt/xvrl2html.xslt",
+        path_to_index_xslt: str = "./xslt/xvrl2html-index.xslt",
+    ):
+        self.path_to_output_html = path_to_output_html
+        self.output_dir = dirname(abspath(path_to_output_html))
+        self.chunk_size = chunk_size
+        self.incremental = incremental
+        self.path_to_xslt = abspath(path_to_xslt)
+        self.path_to_index_xslt = abspath(path_to_index_xslt)
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) if workers > 1 else None
+        self.run_metadata: Optional[etree._Element] = None
+        self.digest: Optional[etree._Element] = None
+        self.reports: List[etree._Element] = []
+        self.count = 0
+        # Per chunk: its `mm:Chunk` element and the future of its rendering
+        self.chunks: List[tuple] = []
+        self.tmp_dir = tempfile.mkdtemp(prefix=".chunks-", dir=self.output_dir)
+        self.closed = False
+    #
+    def __enter__(self):
+        return self
+    #
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self._shutdown()
+        elif not self.closed:
+            self.close()
+    #
+    def add_metadata(self, metadata: etree._Element):
+        """The run's metadata: repeated on every chunk page."""
+        self.run_metadata = metadata
+    #
+    def add_digest(self, digest: etree._Element):
+        """The run's digest (eg. with the EndTime): only shows on the index."""
+        self.digest = digest
+    #
+    def add(self, report: etree._Element):
+        self.reports.append(report)
+        if len(self.reports) >= self.chunk_size:
+            self._flush()
+    #
+    def close(self) -> str:
+        """Render the last chunk, wait for all chunks and write the index.
+        Returns the absolute filepath of the index."""
+        self.closed = True
+        try:
+            self._flush()
+            for _, future in self.chunks:
+                future.result()
+            self._write_index()
+        finally:
+            self._shutdown()
+        return abspath(self.path_to_output_html)
+    #
+    def _shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+    #
+    def _new_doc(self) -> etree._Element:
+        root = etree.Element(f"{{{NS_MAP['xvrl']}}}reports", nsmap=NS_MAP)
+        if self.run_metadata is not None:
+            root.append(copy.deepcopy(self.run_metadata))
+        return root
+    #
+    def _flush(self):
+        if not self.reports:
+            return
+        nr = len(self.chunks) + 1
+        first = self.count + 1
+        self.count += len(self.reports)
+        valid = sum(1 for report in self.reports if is_valid(report))
+        root = self._new_doc()
+        root.extend(self.reports)
+        self.reports = []
+        path_to_xml = join(self.tmp_dir, f"chunk_{nr:04}.xml")
+        etree.ElementTree(root).write(path_to_xml, encoding="UTF-8", xml_declaration=True)
+        href = f"report_{nr:04}.html"
+        params = {"offset": str(first - 1), "up-url": f"./{href}", "index-url": f"./{os.path.basename(self.path_to_output_html)}"}
+        args = (self.path_to_xslt, path_to_xml, join(self.output_dir, href), params)
+        if self.pool is None:
+            future = Future()
+            future.set_result(render_chunk(*args))
+        else:
+            future = self.pool.submit(render_chunk, *args)
+        chunk = etree.Element(CHUNK_TAG, {
+            "href": f"./{href}",
+            "first": str(first),
+            "last": str(self.count),
+            "valid": str(valid),
+            "invalid": str(self.count - first + 1 - valid),
+        })
+        self.chunks.append((chunk, future))
+        if self.incremental:
+            self._write_index()
+    #
+    def _write_index(self):
+        root = self._new_doc()
+        for chunk, future in self.chunks:
+            if future.done():
+                root.append(copy.deepcopy(chunk))
+        if self.digest is not None:
+            root.append(copy.deepcopy(self.digest))
+        path_to_xml = join(self.tmp_dir, "index.xml")
+        etree.ElementTree(root).write(path_to_xml, encoding="UTF-8", xml_declaration=True)
+        xvrl.transformer.transform_to_file(self.path_to_index_xslt, path_to_xml, self.path_to_output_html)
+
+
+def render_xvrl(path_to_xvrl: str, path_to_output_html: str, chunk_size: int = 1000, workers: int = 1) -> str:
+    """Render an XVRL-file (on disk) in chunks, streaming through it so that
+    the whole document is never in memory.
+    Returns the absolute filepath of the index."""
+    with ShardedReportRenderer(path_to_output_html, chunk_size, workers) as renderer:
+        root = None
+        depth = 0
+        for event, el in etree.iterparse(path_to_xvrl, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = el
+                depth += 1
+                continue
+            depth -= 1
+            # Only the children of the root: the metadata, the reports and
+            # the digest
+            if depth != 1:
+                continue
+            if el.tag == REPORT_TAG:
+                renderer.add(copy.deepcopy(el))
+            elif el.tag == METADATA_TAG:
+                renderer.add_metadata(copy.deepcopy(el))
+            elif el.tag == DIGEST_TAG:
+                renderer.add_digest(copy.deepcopy(el))
+            # Free what has been handled
+            el.clear()
+            while el.getprevious() is not None:
+                del root[0]
+        return renderer.close()
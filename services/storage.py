@@ -0,0 +1,59 @@
+"""
+# storage.py
+
+Storage modes for a record's original metadata in the database: the full
+sidecar takes up most of the table (and of its WAL and backups), while audits
+mostly need less.
+"""
+
+# Std
+import zlib
+import hashlib
+from enum import Enum
+from typing import Optional
+# Local
+from services import xvrl
+from services.db import MhCleanupRecord
+
+
+class StorageMode(str, Enum):
+    FULL = "full"  # The full sidecar, as returned by MediaHaven
+    REDUCED = "reduced"  # Only the Descriptive and Dynamic nodes
+    COMPRESSED = "compressed"  # The full sidecar, zlib-compressed
+    HASH = "hash"  # Only the SHA-256 of the full sidecar
+
+    def __str__(self):
+        return self.value
+
+    @property
+    def needs_compact_columns(self) -> bool:
+        """Whether the mode needs the columns of `migrations/003_compact_metadata.sql`."""
+        return self in (StorageMode.COMPRESSED, StorageMode.HASH)
+
+
+def store_original_metadata(item: MhCleanupRecord, sidecar_xml: str, mode: StorageMode):
+    """Set the original metadata of the item in the column(s) of the mode."""
+    item.original_metadata = None
+    item.original_metadata_zlib = None
+    item.original_metadata_sha256 = None
+    if mode == StorageMode.FULL:
+        item.original_metadata = sidecar_xml
+    elif mode == StorageMode.REDUCED:
+        item.original_metadata = xvrl.reduceSidecar(sidecar_xml)
+    elif mode == StorageMode.COMPRESSED:
+        item.original_metadata_zlib = zlib.compress(sidecar_xml.encode("utf-8"))
+    else:
+        item.original_metadata_sha256 = sha256_of(sidecar_xml)
+
+
+def load_original_metadata(item: MhCleanupRecord) -> Optional[str]:
+    """The original metadata as stored, decompressed if needed. `None` when
+    only its hash was stored: compare `sha256_of` the sidecar at hand with
+    `item.original_metadata_sha256` instead."""
+    if item.original_metadata_zlib is not None:
+        return zlib.decompress(item.original_metadata_zlib).decode("utf-8")
+    return item.original_metadata
+
+
+def sha256_of(sidecar_xml: str) -> str:
+    return hashlib.sha256(sidecar_xml.encode("utf-8")).hexdigest()
@@ -0,0 +1,55 @@
+"""
+# xpath.py
+
+Precompiled XPath-evaluators for the MediaHaven sidecar fields we need on the
+per-record hot path. Compiled once, at import.
+"""
+
+# Std
+from functools import lru_cache
+# 3d
+from lxml import etree
+# Libs
+from meemoo_mtd.mediahaven_config import CURRENT_SIDECAR_NAMESPACES
+
+
+# Sidecars in a MediaHaven `records`-search response
+SIDECAR_XPATH = '/Response/Results/mhs:Sidecar'
+FID_XPATH = 'mhs:Sidecar/mhs:Internal/mh:FragmentId'
+
+sidecars = etree.XPath(SIDECAR_XPATH, namespaces=CURRENT_SIDECAR_NAMESPACES)
+# NaN when the response does not say
+total_nr_of_results = etree.XPath("number(/Response/TotalNrOfResults)")
+
+fragment_id = etree.XPath("string(mhs:Internal/mh:FragmentId)", namespaces=CURRENT_SIDECAR_NAMESPACES)
+last_modified = etree.XPath("string(mhs:Administrative/mh:LastModifiedDate)", namespaces=CURRENT_SIDECAR_NAMESPACES)
+
+# All record-metadata fields in one evaluation, relative to the sidecar
+REC_META_FIELDS = (
+    "mhs:Internal/mh:MediaObjectId",
+    "mhs:Internal/mh:FragmentId",
+    "mhs:Administrative/mh:ExternalId",
+    "mhs:Administrative/mh:Type",
+    "mhs:Internal/mh:PathToKeyframe",
+)
+rec_meta_nodes = etree.XPath(" | ".join(REC_META_FIELDS), namespaces=CURRENT_SIDECAR_NAMESPACES)
+
+
+def rec_meta_fields(sidecar: etree.Element) -> dict:
+    """Extract the record-metadata fields of a sidecar as a dict, keyed by the
+    field's localname. Missing or empty fields are left out, so that the
+    caller's defaults apply."""
+    fields = {}
+    for node in rec_meta_nodes(sidecar):
+        if node.text:
+            fields.setdefault(etree.QName(node).localname, node.text)
+    return fields
+
+
+@lru_cache(maxsize=None)
+def field_values(key: str) -> etree.XPath:
+    """Compiled XPath for the values of a field, given as its dotted MediaHaven
+    key (eg. `Dynamic.dc_identifier_localid`), relative to the sidecar.
+    Matches on local-name since not all sections share the same namespace."""
+    steps = "/".join(f"*[local-name()='{part}']" for part in key.split("."))
+    return etree.XPath(f"{steps}/text()")
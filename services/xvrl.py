@@ -6,7 +6,9 @@ TODO: Abstract into a library.
 """
 
 # Std
-from os.path import abspath
+import threading
+from contextlib import ExitStack
+from os.path import abspath, getmtime
 from enum import Enum
 from dataclasses import dataclass
 from datetime import datetime
@@ -40,37 +42,52 @@ class SerializationFormat(str, Enum):
 class Node:
     """Generic XVRL Node
     If no namespace is provided, the default XVRL namespace is assumed.
+    Children are kept in one list, so siblings may share a name; the first
+    child with a given name is accessible via the dot-accessor.
     """
+    __slots__ = ("name", "ns", "data", "attribs", "cdata", "children")
+    #
     def __init__(self,
             name: str,
             ns: str | None = "http://www.xproc.org/ns/xvrl",
             data: str | None = None,
-            attribs: dict = {},
+            attribs: dict | None = None,
             cdata: bool = False):
         self.name = name
         self.ns = ns
         self.data = data
         self.cdata = cdata
-        self.attribs = attribs
+        self.attribs = attribs if attribs is not None else {}
         self.children = []
     #
     def __str__(self):
         return f"XVRL node: {self.name}"
     #
+    def __getattr__(self, name: str):
+        # Only called for names that are not slots (or unset slots)
+        if name.startswith("__") or name in Node.__slots__:
+            raise AttributeError(name)
+        for child in self.children:
+            if child.name == name:
+                return child
+        raise AttributeError(f"{self} has no child node: {name}")
+    #
     def add(self, *nodes):
-        """Add a child node
-        TODO: Obviously, nodes with the same name will not be seperatly
-        accessible via the dot-accessor."""
-        for node in nodes:
-            self.children.append(node)
-            setattr(self, node.name, node)
+        """Add one or more child nodes."""
+        self.children.extend(nodes)
     #
-    def to_Etree(self):
+    def find_all(self, name: str) -> list:
+        """All child nodes with the given name."""
+        return [child for child in self.children if child.name == name]
+    #
+    def to_Etree(self, parent: etree.Element | None = None):
+        """Build this node, and its children, straight into lxml: as a
+        sub-element of `parent` when given."""
         me = create_Etree_element(
-            name=self.name, ns=self.ns, data=self.data, attribs=self.attribs, cdata=self.cdata
+            name=self.name, ns=self.ns, data=self.data, attribs=self.attribs, cdata=self.cdata, parent=parent
         )
         for child in self.children:
-            me.append(child.to_Etree())
+            child.to_Etree(me)
         return me
     #
     def to_Etree_doc(self):
@@ -103,10 +120,14 @@ class XVRLReport(NamedTuple):
     or_id: str
 
     
-def create_Etree_element(name: str, ns: str | None = None, data: str | None = None, attribs: dict = {}, cdata: bool = False):
-    """"""
+def create_Etree_element(name: str, ns: str | None = None, data: str | None = None, attribs: dict | None = None, cdata: bool = False, parent: etree.Element | None = None):
+    """Create an lxml-element, as a sub-element of `parent` when given (a new
+    root declares the prefixes of `NS_MAP`)."""
     q_name = f"{{{ns}}}{name}" if ns else name
-    el = etree.Element(q_name, **attribs)
+    if parent is None:
+        el = etree.Element(q_name, nsmap=NS_MAP, **(attribs or {}))
+    else:
+        el = etree.SubElement(parent, q_name, **(attribs or {}))
     el.text = data if not cdata else etree.CDATA(data)
     return el
 
@@ -143,38 +164,135 @@ def create_ReportNode(mh_rec_meta):
     report_node.add(d)
     return report_node
 
+def create_DigestNode(end_time: datetime, report_count: int, error_count: int) -> Node:
+    """The digest of the whole run, with the run-metadata that is only known
+    at the end (eg. the EndTime). Written last by the `XVRLReportWriter`: the
+    `reports` content model only allows a digest after the reports."""
+    d = Node("digest", attribs={
+        "valid": "true" if not error_count else "false",
+        "error-count": str(error_count),
+    })
+    s = Node("supplemental")
+    s.add(Node("EndTime", data=end_time.replace(microsecond=0).isoformat(), ns=NS_MAP["mm"]))
+    s.add(Node("ReportCount", data=str(report_count), ns=NS_MAP["mm"]))
+    d.add(s)
+    return d
+
+class XVRLReportWriter:
+    """Incrementally write an XVRL-document to disk.
+    The document's metadata is written on enter; every report node is written
+    (unbuffered) as soon as it is passed to `write`, so memory use stays flat
+    regardless of the number of reports and a crash does not lose the
+    reports written so far.
+    The nodes are written as nested elements of the document's root, so that
+    they use its namespace prefixes (`xvrl:`, `mh:`, ...) and declarations
+    instead of redeclaring them on every report."""
+    def __init__(self, path: str, doc: Node):
+        self.path = path
+        self.doc = doc
+        self._stack = ExitStack()
+        self._xf = None
+    #
+    def __enter__(self):
+        self._xf = self._stack.enter_context(
+            etree.xmlfile(self.path, encoding="UTF-8", buffered=False)
+        )
+        self._xf.write_declaration()
+        self._stack.enter_context(
+            self._xf.element(f"{{{self.doc.ns}}}{self.doc.name}", nsmap=NS_MAP)
+        )
+        # Runs before the root is closed
+        self._stack.callback(self._xf.write, "\n")
+        for child in self.doc.children:
+            self.write(child)
+        return self
+    #
+    def __exit__(self, *exc):
+        return self._stack.__exit__(*exc)
+    #
+    def write(self, node: Node) -> etree.Element:
+        """Write the node; returns it as the element that was written."""
+        self._write_node(node, 0)
+        el = node.to_Etree()
+        cleanup_namespaces(el)
+        return el
+    #
+    def _write_node(self, node: Node, level: int):
+        """Write the node (pretty-printed) within the open elements."""
+        q_name = f"{{{node.ns}}}{node.name}" if node.ns else node.name
+        self._xf.write("\n" + "  " * level)
+        with self._xf.element(q_name, node.attribs):
+            if node.data is not None:
+                self._xf.write(etree.CDATA(node.data) if node.cdata else node.data)
+            for child in node.children:
+                self._write_node(child, level + 1)
+            if node.children:
+                self._xf.write("\n" + "  " * level)
+
 def cleanup_namespaces(tree):
     """"""
     etree.cleanup_namespaces(tree, top_nsmap=NS_MAP)
 
+class XsltTransformer:
+    """Long-lived XSLT-transformer: one Saxon processor per process and every
+    stylesheet compiled only once, cached by path and mtime.
+    Compiled executables are kept per thread since setting parameters on a
+    shared executable is not thread-safe."""
+    def __init__(self):
+        self._proc = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    #
+    @property
+    def proc(self) -> PySaxonProcessor:
+        with self._lock:
+            if self._proc is None:
+                self._proc = PySaxonProcessor(license=False)
+            return self._proc
+    #
+    def executable(self, path_to_xslt: str, params: dict = {}):
+        """Return the compiled stylesheet, (re)compiling it when the file is new
+        or has changed on disk."""
+        path = abspath(path_to_xslt)
+        key = (path, getmtime(path))
+        cache = self._local.__dict__.setdefault("cache", {})
+        if key not in cache:
+            for stale in [k for k in cache if k[0] == path]:
+                del cache[stale]
+            cache[key] = self.proc.new_xslt30_processor().compile_stylesheet(stylesheet_file=path)
+        executable = cache[key]
+        executable.clear_parameters()
+        for k, v in params.items():
+            executable.set_parameter(k, self.proc.make_string_value(v))
+        return executable
+    #
+    def transform_to_string(self, path_to_xslt: str, xml_text: str, params: dict = {}) -> str:
+        document = self.proc.parse_xml(xml_text=xml_text)
+        return self.executable(path_to_xslt, params).transform_to_string(xdm_node=document)
+    #
+    def transform_to_file(self, path_to_xslt: str, path_to_xml: str, path_to_output: str, params: dict = {}) -> str:
+        document = self.proc.parse_xml(xml_file_name=path_to_xml)
+        self.executable(path_to_xslt, params).transform_to_file(output_file=path_to_output, xdm_node=document)
+        return abspath(path_to_output)
+
+# One transformer per process
+transformer = XsltTransformer()
+
 def writeXVRL2html(path_to_xvrl: str, path_to_output_html: str, path_to_xslt: str = "./xslt/xvrl2html.xslt", params: dict = {}) -> str:
     """Transform XVRL-file (on disk) to html via XSLT and write the main report
     file out to disk.
     One html-file per report-detail will be written to disk as well.
     Returns the absolute filepath of the output HTML-file."""
-    with PySaxonProcessor(license=False) as proc:
-        xsltproc = proc.new_xslt30_processor()
-        # Input XML is relative to lib's root
-        document = proc.parse_xml(xml_file_name=path_to_xvrl)
-        executable = xsltproc.compile_stylesheet(stylesheet_file=path_to_xslt)
-        # XSLT params given?
-        for k, v in params.items():
-            executable.set_parameter(k, proc.make_string_value(v))
-        # ~ output = executable.transform_to_string(xdm_node=document)
-        executable.transform_to_file(output_file=path_to_output_html, xdm_node=document)
-        return abspath(path_to_output_html)
+    return transformer.transform_to_file(path_to_xslt, path_to_xvrl, path_to_output_html, params)
 
-def reduceSidecar(sidecar_as_etree: etree.Element, path_to_xslt: str = "./xslt/reduceSidecar.xslt", params: dict = {}) -> str:
+def reduceSidecar(sidecar: etree.Element | str | bytes, path_to_xslt: str = "./xslt/reduceSidecar.xslt", params: dict = {}) -> str:
     """Reduce a Sidecar-XML to only the Descriptve and Dynamic-nodes.
+    The sidecar can be given as an lxml-element or as (already serialized) XML.
     TODO: should NOT be in xvrl..."""
-    with PySaxonProcessor(license=False) as proc:
-        xsltproc = proc.new_xslt30_processor()
-        # Input XML is relative to lib's root
-        xml_text = etree.tostring(sidecar_as_etree, encoding='UTF-8', pretty_print=True).decode()
-        document = proc.parse_xml(xml_text=xml_text)
-        executable = xsltproc.compile_stylesheet(stylesheet_file=path_to_xslt)
-        # XSLT params given?
-        for k, v in params.items():
-            executable.set_parameter(k, proc.make_string_value(v))
-        return executable.transform_to_string(xdm_node=document)
-
+    if isinstance(sidecar, bytes):
+        xml_text = sidecar.decode("utf-8")
+    elif isinstance(sidecar, str):
+        xml_text = sidecar
+    else:
+        xml_text = etree.tostring(sidecar, encoding="unicode")
+    return transformer.transform_to_string(path_to_xslt, xml_text, params)
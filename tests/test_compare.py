@@ -0,0 +1,72 @@
+import pytest
+from lxml import etree
+
+from services.compare import is_noop_update
+
+SIDECAR = b"""<mhs:Sidecar xmlns:mhs="https://zeticon.mediahaven.com/metadata/25.1/mhs/">
+  <mhs:Descriptive>
+    <Title>Een titel</Title>
+  </mhs:Descriptive>
+  <mhs:Dynamic>
+    <dc_title>Een titel</dc_title>
+    <dc_rights_licenses>
+      <multiselect>VIAA-ONDERWIJS</multiselect>
+      <multiselect>VIAA-ONDERZOEK</multiselect>
+    </dc_rights_licenses>
+  </mhs:Dynamic>
+</mhs:Sidecar>"""
+
+
+def update_object(dynamic: str) -> str:
+    return f"""<MhUpdateObject>
+  <Reason>JIRA-1</Reason>
+  <Dynamic>{dynamic}</Dynamic>
+</MhUpdateObject>"""
+
+
+def licenses(strategy: str, *values: str) -> str:
+    multiselects = "".join(f"<multiselect>{v}</multiselect>" for v in values)
+    return f'<dc_rights_licenses mergeStrategy="{strategy}">{multiselects}</dc_rights_licenses>'
+
+
+@pytest.fixture
+def sidecar():
+    return etree.fromstring(SIDECAR)
+
+
+@pytest.mark.parametrize("dynamic, noop", [
+    # OVERWRITE (the default): only the same value, ignoring surrounding whitespace
+    ("<dc_title> Een titel </dc_title>", True),
+    ("<dc_title>Een andere titel</dc_title>", False),
+    (licenses("OVERWRITE", "VIAA-ONDERZOEK", "VIAA-ONDERWIJS"), True),
+    (licenses("OVERWRITE", "VIAA-ONDERWIJS"), False),
+    # KEEP: never changes an existing field, but adds a missing one
+    ('<dc_title mergeStrategy="KEEP">Een andere titel</dc_title>', True),
+    ('<dc_description mergeStrategy="KEEP">Een beschrijving</dc_description>', False),
+    # MERGE: only when all values are already present
+    (licenses("MERGE", "VIAA-ONDERWIJS"), True),
+    (licenses("merge", "VIAA-ONDERWIJS", "VIAA-INTRA_CP-CONTENT"), False),
+    # SUBTRACT: only when none of the values are present
+    (licenses("SUBTRACT", "VIAA-INTRA_CP-CONTENT"), True),
+    (licenses("SUBTRACT", "VIAA-ONDERZOEK"), False),
+    ('<dc_description mergeStrategy="SUBTRACT">Een beschrijving</dc_description>', True),
+    # A field that is not in the sidecar yet
+    ("<dc_description>Een beschrijving</dc_description>", False),
+])
+def test_is_noop_update(sidecar, dynamic, noop):
+    assert is_noop_update(update_object(dynamic), sidecar) is noop
+
+
+def test_all_fields_have_to_be_unchanged(sidecar):
+    dynamic = "<dc_title>Een titel</dc_title><dc_description>Een beschrijving</dc_description>"
+    assert not is_noop_update(update_object(dynamic), sidecar)
+
+
+def test_leaf_elements_under_the_root_are_not_compared(sidecar):
+    assert is_noop_update(update_object("<dc_title>Een titel</dc_title>").encode("utf-8"), sidecar)
+    assert is_noop_update("<MhUpdateObject><Reason>JIRA-1</Reason></MhUpdateObject>", sidecar)
+
+
+def test_section_missing_from_the_sidecar(sidecar):
+    update = "<MhUpdateObject><Administrative><ExternalId>abc</ExternalId></Administrative></MhUpdateObject>"
+    assert not is_noop_update(update, sidecar)
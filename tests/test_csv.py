@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("meemoo_mtd")
+
+from services.csv import CsvParser
+
+HEADER = "Dynamic.dc_identifier_localid,Dynamic.dc_title"
+
+
+def write_csv(tmp_path, text: str, newline: str = "\n") -> str:
+    path = tmp_path / "input.csv"
+    path.write_bytes(text.replace("\n", newline).encode("utf-8"))
+    return str(path)
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_offsets_point_to_the_start_of_each_row(tmp_path, newline):
+    path = write_csv(tmp_path, f"{HEADER}\nid-1,Één\nid-2,\"Two\nlines\"\nid-3,Drie ☃\n", newline)
+    parsed = CsvParser(path)
+    assert len(parsed) == 3
+    data = open(path, "rb").read()
+    for offset, identifier in zip(parsed.offsets, ["id-1", "id-2", "id-3"]):
+        assert data[offset:].startswith(identifier.encode("utf-8"))
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_iterator_starts_at_any_row(tmp_path, newline):
+    path = write_csv(tmp_path, f"{HEADER}\nid-1,Één\nid-2,\"Two\nlines\"\nid-3,Drie ☃\n", newline)
+    parsed = CsvParser(path)
+    rows = list(parsed.iterator())
+    assert [row["Dynamic.dc_identifier_localid"] for row in rows] == ["id-1", "id-2", "id-3"]
+    assert rows[1]["Dynamic.dc_title"] == f"Two{newline}lines"
+    for start in range(3):
+        assert list(parsed.iterator(start)) == rows[start:]
+    assert list(parsed.iterator(1, 2)) == rows[1:2]
+    assert list(parsed.iterator(3)) == []
+
+
+def test_header_and_columns(tmp_path):
+    parsed = CsvParser(write_csv(tmp_path, f"{HEADER}\nid-1,Een\n"))
+    assert parsed.id_col == "Dynamic.dc_identifier_localid"
+    assert parsed.data_cols == ["Dynamic.dc_title"]
+
+
+def test_column_mismatch_and_duplicates(tmp_path):
+    parsed = CsvParser(write_csv(tmp_path, f"{HEADER}\nid-1,Een\nid-1\n"))
+    assert parsed.structure_error.startswith("Error in row 3")
+    assert parsed.get_duplicates_in_column() == {"id-1": 2}
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from services.journal import Journal
+
+RUN = {"input_file": "/tmp/input.csv", "or_id": "OR-a1b2c3d", "reason": "JIRA-1", "dryrun": False}
+
+
+def write_journal(path, *entries):
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+
+
+def test_new_journal_starts_at_the_first_row(tmp_path):
+    with Journal(str(tmp_path / "journal.jsonl"), RUN) as journal:
+        assert journal.next_row == 0
+        assert journal.failed_rows == []
+        journal.row_done(0, "id-1", "DONE")
+    lines = (tmp_path / "journal.jsonl").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["type"] for line in lines] == ["run", "row"]
+
+
+def test_load_resumes_after_the_last_row_and_retries_failed_rows(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    write_journal(
+        path,
+        {"type": "run", **RUN},
+        {"type": "row", "row": 0, "IdentifierValue": "id-1", "status": "DONE"},
+        {"type": "record", "row": 1, "FragmentId": "f-2", "status": "DONE"},
+        {"type": "row", "row": 1, "IdentifierValue": "id-2", "status": "ERROR"},
+        {"type": "row", "row": 2, "IdentifierValue": "id-3", "status": "ERROR"},
+        {"type": "row", "row": 3, "IdentifierValue": "id-4", "status": "DONE"},
+        # Row 2 succeeded when retried by a later run
+        {"type": "run", **RUN},
+        {"type": "row", "row": 2, "IdentifierValue": "id-3", "status": "DONE"},
+    )
+    journal = Journal(str(path), RUN, resume=True)
+    journal.load()
+    assert journal.next_row == 4
+    assert journal.failed_rows == [1]
+    assert journal.done_records == {"f-2"}
+
+
+def test_load_refuses_another_run(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    write_journal(path, {"type": "run", **RUN, "dryrun": True})
+    journal = Journal(str(path), RUN, resume=True)
+    with pytest.raises(ValueError):
+        journal.load()
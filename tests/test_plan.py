@@ -0,0 +1,37 @@
+import json
+
+from services.plan import PlanEntry, UpdatePlanWriter, fingerprint, read_update_plan
+
+MHS = "https://zeticon.mediahaven.com/metadata/25.1/mhs/"
+SIDECAR = f"""<mhs:Sidecar xmlns:mhs="{MHS}" version="25.1">
+  <mhs:Dynamic><dc_title>Title</dc_title></mhs:Dynamic>
+</mhs:Sidecar>"""
+
+
+def test_fingerprint_ignores_unused_namespaces_and_indentation():
+    reformatted = (
+        f'<mhs:Sidecar xmlns:foo="urn:foo" xmlns:mhs="{MHS}" version="25.1">'
+        "<mhs:Dynamic>\n      <dc_title>Title</dc_title>\n   </mhs:Dynamic></mhs:Sidecar>"
+    )
+    assert fingerprint(reformatted) == fingerprint(SIDECAR)
+
+
+def test_fingerprint_changes_with_the_values():
+    assert fingerprint(SIDECAR.replace("Title", "Other")) != fingerprint(SIDECAR)
+
+
+def test_plan_round_trip(tmp_path):
+    path = tmp_path / "update_plan.jsonl"
+    entry = PlanEntry("fid", "id-1", "2024-01-01T00:00:00Z", "<UpdateObject/>", fingerprint(SIDECAR))
+    with UpdatePlanWriter(str(path)) as writer:
+        writer.write(entry)
+    assert list(read_update_plan(str(path))) == [entry]
+
+
+def test_plan_without_hash_reads_as_empty(tmp_path):
+    path = tmp_path / "update_plan.jsonl"
+    path.write_text(json.dumps({
+        "FragmentId": "fid", "IdentifierValue": "id-1", "LastModifiedDate": "", "UpdateObject": "<UpdateObject/>",
+    }) + "\n", encoding="utf-8")
+    [entry] = read_update_plan(str(path))
+    assert entry.ReducedSha256 == ""
@@ -0,0 +1,97 @@
+import pytest
+
+pytest.importorskip("mediahaven")
+
+from mediahaven.mediahaven import MediaHavenException
+
+from services.ratelimit import RateLimiter, is_throttled
+
+
+class FlakyCall:
+    """Fails with the given status codes, in order, then succeeds."""
+    def __init__(self, *status_codes):
+        self.status_codes = list(status_codes)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.status_codes:
+            raise MediaHavenException(status_code=self.status_codes.pop(0), message="Nope")
+        return "OK"
+
+
+def test_is_throttled():
+    assert is_throttled(429)
+    assert is_throttled(503)
+    assert not is_throttled(500)
+    assert not is_throttled(404)
+    assert not is_throttled(None)
+
+
+def test_throttled_halves_the_rate_down_to_min_rate():
+    limiter = RateLimiter(8.0, min_rate=1.5)
+    limiter.throttled()
+    assert limiter.rate == 4.0
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.rate == 1.5
+
+
+def test_healthy_ramps_back_up_to_the_target_rate():
+    limiter = RateLimiter(10.0)
+    limiter.throttled()
+    limiter.healthy()
+    assert limiter.rate == pytest.approx(5.1)
+    for _ in range(100):
+        limiter.healthy()
+    assert limiter.rate == 10.0
+
+
+def test_unlimited_pauses_longer_on_consecutive_throttles():
+    limiter = RateLimiter(None, min_pause=0.5, max_pause=1.5)
+    limiter.throttled()
+    assert limiter.rate is None
+    assert limiter.pause == 0.5
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.pause == 1.5
+    limiter.healthy()
+    assert limiter.pause == 0.0
+
+
+def test_call_retries_throttled_requests():
+    limiter = RateLimiter(1000.0)
+    call = FlakyCall(429, 503)
+    assert limiter.call(call) == "OK"
+    assert call.calls == 3
+    assert limiter.rate < 1000.0
+
+
+def test_call_does_not_retry_other_errors():
+    limiter = RateLimiter(1000.0)
+    call = FlakyCall(500)
+    with pytest.raises(MediaHavenException):
+        limiter.call(call)
+    assert call.calls == 1
+    assert limiter.rate == 1000.0
+
+
+def test_call_gives_up_after_max_retries():
+    limiter = RateLimiter(None, max_retries=2, min_pause=0.001)
+    call = FlakyCall(429, 429, 429, 429)
+    with pytest.raises(MediaHavenException):
+        limiter.call(call)
+    assert call.calls == 3
+
+
+def test_call_retries_unauthorized_once():
+    limiter = RateLimiter(1000.0)
+    call = FlakyCall(401)
+    assert limiter.call(call) == "OK"
+    assert call.calls == 2
+    assert limiter.rate == 1000.0
+
+    call = FlakyCall(401, 401)
+    with pytest.raises(MediaHavenException):
+        limiter.call(call)
+    assert call.calls == 2